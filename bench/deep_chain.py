@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Check that the cost per stage stays flat as ``|`` chains get deeper.
+
+    python bench/deep_chain.py [--items N] [--depths 10,100,1000,5000]
+
+For each depth, builds a chain of that many generator stages (once
+left-associated, as ``((a | b) | c)``, and once right-associated, as
+``(a | (b | c))``), and reports the time taken to build it, and the time per
+item per stage to run N items through it. Both should stay roughly constant
+as the depth grows.
+"""
+
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+from calabash.pipeline import pipe
+
+
+@pipe
+def passthrough(stdin):
+    for item in stdin:
+        yield item
+
+
+def left_chain(items, depth):
+    pl = passthrough()
+    for _ in xrange(depth - 1):
+        pl = pl | passthrough()
+    return xrange(items) | pl
+
+
+def right_chain(items, depth):
+    pl = passthrough()
+    for _ in xrange(depth - 1):
+        pl = passthrough() | pl
+    return xrange(items) | pl
+
+
+def timed(build, items, depth):
+    start = time.time()
+    pipeline = build(items, depth)
+    built = time.time()
+    for _ in pipeline:
+        pass
+    finished = time.time()
+    return ((built - start) / depth * 1e6,
+            (finished - built) / (items * depth) * 1e9)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--items', type='int', default=10000)
+    parser.add_option('--depths', default='10,100,1000,5000')
+    options, _ = parser.parse_args()
+
+    print '%6s  %-6s %16s %20s' % ('depth', 'assoc', 'build us/stage',
+                                   'run ns/item/stage')
+    for depth in [int(depth) for depth in options.depths.split(',')]:
+        for assoc, build in (('left', left_chain), ('right', right_chain)):
+            build_cost, run_cost = timed(build, options.items, depth)
+            print '%6d  %-6s %16.2f %20.1f' % (depth, assoc, build_cost,
+                                               run_cost)
+
+
+if __name__ == '__main__':
+    main()
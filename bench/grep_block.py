@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compare line-by-line and block-mode grep on a sparse-match workload.
+
+    python bench/grep_block.py [--lines N] [--every K]
+
+Generates N log-like lines, one in every K of which matches, writes them to a
+temporary file, and times ``cat(f) | grep(p)`` against
+``cat(f, chunk_size=...) | grep(p, block=True)``.
+"""
+
+import optparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+from calabash.common import cat, grep
+
+
+def make_log(path, lines, every):
+    with open(path, 'w') as log:
+        for i in xrange(lines):
+            status = 500 if i % every == 0 else 200
+            log.write('2011-02-03 12:00:%02d host%d GET /path/%d %d 1234\n' %
+                      (i % 60, i % 50, i, status))
+
+
+def timed(pipeline):
+    start = time.time()
+    matches = sum(1 for _ in pipeline)
+    return matches, time.time() - start
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--lines', type='int', default=1000000)
+    parser.add_option('--every', type='int', default=10000)
+    parser.add_option('--pattern', default=r' 5\d\d ')
+    options, _ = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+    try:
+        make_log(path, options.lines, options.every)
+        line_matches, line_time = timed(cat(path) | grep(options.pattern))
+        block_matches, block_time = timed(
+            cat(path, chunk_size=1 << 20) | grep(options.pattern, block=True))
+    finally:
+        os.unlink(path)
+
+    assert line_matches == block_matches
+    print 'matches:    %d of %d lines' % (line_matches, options.lines)
+    print 'line mode:  %.3fs' % line_time
+    print 'block mode: %.3fs' % block_time
+    print 'speedup:    %.1fx' % (line_time / block_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Time pipeline combinators and the common stages on synthetic input.
+
+    python bench/suite.py [--items N] [--depths 1,10,100,1000] [--repeat R]
+                          [--only TEXT] [--output results.json]
+                          [--compare old.json] [--tolerance 0.25]
+
+Every case runs in a forked child process, so that its peak memory (the
+child's ``ru_maxrss``) isn't muddied by the cases before it. For each case
+the suite reports the number of input items per second (the best of
+``--repeat`` runs), the number of items produced, and the peak and added
+resident memory in kilobytes. A case which
+raises (such as a chain too deep for the interpreter) records the error
+instead.
+
+Use ``--output`` to save the results as JSON, and ``--compare`` to check a
+run against saved results; cases which have slowed down by more than
+``--tolerance`` are listed, and the exit status is non-zero if there are any.
+Timings on a busy machine can easily vary by 10-20% from run to run, so
+compare runs made on the same, otherwise idle, machine.
+"""
+
+import json
+import optparse
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import traceback
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+from calabash.common import cat, filter, grep, map, sed, sh
+from calabash.pipeline import pipe
+
+
+@pipe
+def passthrough(stdin):
+    for item in stdin:
+        yield item
+
+
+@pipe
+def numbers(count):
+    return iter(xrange(count))
+
+
+def identity(item):
+    return item
+
+
+def make_lines(count):
+    return ['2011-02-03 12:00:%02d host%d GET /path/%d %d 1234\n' %
+            (i % 60, i % 50, i, 500 if i % 100 == 0 else 200)
+            for i in xrange(count)]
+
+
+def chain(count, depth, stage):
+    pl = numbers(count)
+    for _ in xrange(depth):
+        pl = pl | stage()
+    return pl
+
+
+def cases(options, path):
+    """Yield ``(name, build)`` pairs; `build` returns the pipeline to run."""
+    n = options.items
+    for depth in options.depths:
+        yield ('chain/fused-map/depth=%d' % depth,
+               lambda depth=depth: chain(n, depth, lambda: map(identity)))
+        yield ('chain/generator/depth=%d' % depth,
+               lambda depth=depth: chain(n, depth, passthrough))
+
+    yield 'fanout/concat', lambda: numbers(n) | (map(identity) + map(identity))
+    yield ('fanout/concat-replay',
+           lambda: range(n) | (map(identity) + map(identity)))
+    side = int(n ** 0.5)
+    yield 'fanout/product', lambda: numbers(side) * numbers(side)
+    yield ('fanout/product-spilled',
+           lambda: numbers(side).product(numbers(side),
+                                         spill_threshold=side // 4))
+
+    yield 'stage/map', lambda: numbers(n) | map(identity)
+    yield 'stage/filter', lambda: numbers(n) | filter(bool)
+    yield 'stage/grep', lambda: iter(make_lines(n)) | grep(r' 5\d\d ')
+    yield 'stage/grep-literal', lambda: iter(make_lines(n)) | grep('host7 ')
+    yield ('stage/sed',
+           lambda: iter(make_lines(n)) | sed(r'host(\d+)', r'node\1'))
+    yield 'stage/cat', lambda: cat(path)
+    yield 'stage/cat-chunked', lambda: cat(path, chunk_size=1 << 20)
+    yield 'stage/sh', lambda: iter(make_lines(n)) | sh('cat')
+
+
+def measure(build, items, repeat):
+    """Run one case in this process, returning its best result."""
+    start_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    best = None
+    for _ in xrange(repeat):
+        pipeline = build()
+        start = time.time()
+        produced = sum(1 for _ in pipeline)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'seconds': best,
+        'produced': produced,
+        'items_per_second': items / best if best else None,
+        'peak_kb': peak_kb,
+        'added_kb': peak_kb - start_kb,
+    }
+
+
+def run_forked(build, items, repeat):
+    """Run one case in a child process, so memory is measured in isolation."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            result = measure(build, items, repeat)
+        except BaseException, exc:
+            result = {'error': traceback.format_exception_only(
+                type(exc), exc)[-1].strip()}
+        with os.fdopen(write_fd, 'w') as output:
+            json.dump(result, output)
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as output:
+        data = output.read()
+    os.waitpid(pid, 0)
+    if not data:
+        return {'error': 'benchmark process died'}
+    return json.loads(data)
+
+
+def compare(results, baseline, tolerance):
+    """Print each case's speed relative to `baseline`; return regressions."""
+    regressions = []
+    old_results = baseline['results']
+    for name in sorted(results):
+        new, old = results[name], old_results.get(name)
+        if (old is None or not new.get('items_per_second') or
+                not old.get('items_per_second')):
+            continue
+        ratio = new['items_per_second'] / old['items_per_second']
+        flag = ''
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+            flag = '  <-- regression'
+        print '%-34s %6.2fx%s' % (name, ratio, flag)
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--items', type='int', default=100000,
+                      help='number of synthetic input items per case')
+    parser.add_option('--depths', default='1,10,100,1000',
+                      help='comma-separated | chain depths to time')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='run each case this many times, keeping the best')
+    parser.add_option('--only', default='',
+                      help='only run cases whose name contains this text')
+    parser.add_option('--output', help='save the results to this JSON file')
+    parser.add_option('--compare', help='compare against saved JSON results')
+    parser.add_option('--tolerance', type='float', default=0.25,
+                      help='slowdown (as a fraction) counted as a regression')
+    options, _ = parser.parse_args()
+    options.depths = [int(depth) for depth in options.depths.split(',')]
+
+    fd, path = tempfile.mkstemp(suffix='.log')
+    with os.fdopen(fd, 'w') as log:
+        log.writelines(make_lines(options.items))
+
+    results = {}
+    try:
+        for name, build in cases(options, path):
+            if options.only not in name:
+                continue
+            result = results[name] = run_forked(build, options.items,
+                                                 options.repeat)
+            if 'error' in result:
+                print '%-34s %s' % (name, result['error'])
+            else:
+                print '%-34s %12.0f items/s %9d kB peak %9d kB added' % (
+                    name, result['items_per_second'] or 0,
+                    result['peak_kb'], result['added_kb'])
+    finally:
+        os.unlink(path)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'items': options.items,
+        'results': results,
+    }
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        print
+        if compare(results, baseline, options.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,8 @@
 from pipeline import pipe
 import common
+import parallel
+import connections
+import aggregate
 
 
 def _get_tests():
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pipeline components which summarise their input as it streams past.
+
+Rather than writing a generator which fills up a dictionary, use
+:func:`reduce` or :func:`groupby` (both of which can be told to keep only so
+many keys in memory), :func:`window` to cut a stream into chunks by count or
+by time, and :func:`top` for the largest items::
+
+    >>> from calabash.common import map
+    >>> sales = [('apples', 3), ('pears', 1), ('apples', 2), ('plums', 5)]
+    >>> list(sales | reduce(lambda total, sale: total + sale[1], 0,
+    ...                     key=lambda sale: sale[0]))
+    [('apples', 5), ('pears', 1), ('plums', 5)]
+    >>> list(xrange(7) | window(3) | map(sum))
+    [3, 12, 6]
+
+When even the set of keys won't fit in memory, feed a sketch from
+:mod:`calabash.sketches` with :func:`sketch`.
+"""
+
+import collections
+import heapq
+
+from calabash.pipeline import pipe
+
+
+_MISSING = object()
+
+
+@pipe
+def reduce(stdin, func, initial=_MISSING, key=None, max_keys=None):
+    """
+    Combine items with `func`, like the :func:`reduce` builtin.
+
+    Without a `key`, yields the single result once the input runs out
+    (nothing at all for empty input, unless there's an `initial` value)::
+
+        >>> list(xrange(5) | reduce(lambda a, b: a + b))
+        [10]
+
+    With a `key`, items are reduced separately for each ``key(item)``, and
+    ``(key, result)`` pairs are yielded at the end, in the order the keys
+    were first seen. `initial` is shared between keys, so it shouldn't be
+    changed by `func`::
+
+        >>> list('abracadabra' | reduce(lambda n, _: n + 1, 0, key=str))
+        [('a', 5), ('b', 2), ('r', 2), ('c', 1), ('d', 1)]
+
+    To bound memory, pass `max_keys`. When a new key turns up and there are
+    already that many, the result for a key which hasn't been updated
+    recently is yielded straight away, and that key starts again from
+    scratch if it turns up later. So a key may appear more than once, each
+    time with a partial result, which downstream stages need to combine::
+
+        >>> counts = 'abracadabra' | reduce(lambda n, _: n + 1, 0, key=str,
+        ...                                 max_keys=2)
+        >>> len(list(counts))
+        9
+        >>> list(counts | reduce(lambda total, (_, n): total + n, 0,
+        ...                      key=lambda (letter, _): letter))
+        [('a', 5), ('b', 2), ('r', 2), ('c', 1), ('d', 1)]
+    """
+    def fold(result, item):
+        if result is _MISSING:
+            return item
+        return func(result, item)
+
+    if key is None:
+        result = initial
+        for item in stdin:
+            result = fold(result, item)
+        if result is not _MISSING:
+            yield result
+        return
+    for pair in _keyed(stdin, key, lambda: initial, fold, max_keys):
+        yield pair
+
+
+@pipe
+def groupby(stdin, key, max_keys=None):
+    """
+    Collect items into lists by ``key(item)``.
+
+    Unlike :func:`itertools.groupby`, the items for a key needn't be next to
+    each other. ``(key, items)`` pairs are yielded once the input runs out,
+    in the order the keys were first seen::
+
+        >>> words = ['apple', 'bean', 'avocado', 'beet']
+        >>> list(words | groupby(lambda word: word[0]))
+        [('a', ['apple', 'avocado']), ('b', ['bean', 'beet'])]
+
+    `max_keys` bounds memory as for :func:`reduce`, so a key's items may
+    come out in more than one list.
+    """
+    def append(items, item):
+        items.append(item)
+        return items
+
+    return _keyed(stdin, key, list, append, max_keys)
+
+
+def _keyed(stdin, key, start, fold, max_keys):
+    if max_keys is None:
+        results, order = {}, []
+        for item in stdin:
+            value = key(item)
+            result = results.get(value, _MISSING)
+            if result is _MISSING and value not in results:
+                order.append(value)
+                result = start()
+            results[value] = fold(result, item)
+        for value in order:
+            yield value, results[value]
+        return
+
+    # Evict keys in roughly least-recently-updated order, with the "clock"
+    # algorithm: a key which has been updated since it was last looked at
+    # gets a second chance. It keeps the busiest keys in memory about as
+    # well as true LRU, without the cost of reordering on every update.
+    results, queue = {}, collections.deque()
+    for item in stdin:
+        value = key(item)
+        entry = results.get(value)
+        if entry is None:
+            while len(results) >= max_keys:
+                oldest = queue.popleft()
+                old = results[oldest]
+                if old[1]:
+                    old[1] = False
+                    queue.append(oldest)
+                else:
+                    del results[oldest]
+                    yield oldest, old[0]
+            entry = results[value] = [start(), False]
+            queue.append(value)
+        else:
+            entry[1] = True
+        entry[0] = fold(entry[0], item)
+    for value in queue:
+        yield value, results[value][0]
+
+
+@pipe
+def window(stdin, size, step=None, timestamp=None):
+    """
+    Yield lists of items which fall into a moving window.
+
+    By default, windows hold `size` consecutive items, and a new one starts
+    every `step` items (`step` defaults to `size`, so windows don't
+    overlap). Items at the end which wouldn't otherwise be in any window are
+    yielded as a shorter one::
+
+        >>> list(xrange(5) | window(2))
+        [[0, 1], [2, 3], [4]]
+        >>> list(xrange(5) | window(3, step=1))
+        [[0, 1, 2], [1, 2, 3], [2, 3, 4]]
+
+    With a `timestamp` function, windows are by time instead: `size` and
+    `step` are durations, windows start at multiples of `step`, and
+    ``(start, items)`` pairs are yielded for every window holding any
+    items. Timestamps mustn't decrease::
+
+        >>> events = [(0.5, 'a'), (1.2, 'b'), (2.7, 'c'), (9.1, 'd')]
+        >>> for start, items in events | window(2, timestamp=lambda e: e[0]):
+        ...     print start, [e[1] for e in items]
+        0 ['a', 'b']
+        2 ['c']
+        8 ['d']
+        >>> for start, items in events | window(2, step=1,
+        ...                                     timestamp=lambda e: e[0]):
+        ...     print start, [e[1] for e in items]
+        -1 ['a']
+        0 ['a', 'b']
+        1 ['b', 'c']
+        2 ['c']
+        8 ['d']
+        9 ['d']
+
+    Only the items in the current window are kept in memory.
+    """
+    if step is None:
+        step = size
+    if timestamp is None:
+        return _count_windows(stdin, size, step)
+    return _time_windows(stdin, size, step, timestamp)
+
+
+def _count_windows(stdin, size, step):
+    items = collections.deque(maxlen=size)
+    count = start = end = 0
+    for item in stdin:
+        items.append(item)
+        count += 1
+        if count == start + size:
+            yield list(items)
+            start += step
+            end = count
+    if end < count and start < count:
+        yield list(items)[start - count:]
+
+
+def _time_windows(stdin, size, step, timestamp):
+    items = collections.deque()
+    start = latest = None
+    for item in stdin:
+        time = timestamp(item)
+        if start is None:
+            start = _first_window(time, size, step)
+        elif time < latest:
+            raise ValueError("timestamps must not decrease")
+        latest = time
+        while time >= start + size:
+            if items:
+                yield start, [entry[1] for entry in items]
+            start += step
+            while items and items[0][0] < start:
+                items.popleft()
+            if not items:
+                # Skip straight past any windows which would be empty.
+                start = max(start, _first_window(time, size, step))
+        if time >= start:
+            # Otherwise, it's in a gap between windows.
+            items.append((time, item))
+    while items:
+        yield start, [entry[1] for entry in items
+                      if entry[0] < start + size]
+        start += step
+        while items and items[0][0] < start:
+            items.popleft()
+
+
+def _first_window(time, size, step):
+    """The start of the earliest window of `size` holding `time`."""
+    return (int((time - size) // step) + 1) * step
+
+
+@pipe
+def top(stdin, k, key=None):
+    """
+    Yield the `k` largest items, largest first, holding only `k` at a time.
+
+        >>> list(['pear', 'fig', 'banana', 'kiwi'] | top(2, key=len))
+        ['banana', 'pear']
+    """
+    return iter(heapq.nlargest(k, stdin, key=key))
+
+
+@pipe
+def sketch(stdin, sketch, key=None):
+    """
+    Add every item (or ``key(item)``) to a sketch, passing them all through.
+
+    `sketch` is anything with an ``add()`` method, such as the sketches in
+    :mod:`calabash.sketches`; keep hold of it to read it once the pipeline
+    has run::
+
+        >>> from calabash.sketches import HyperLogLog
+        >>> users = HyperLogLog()
+        >>> visits = [('ann', '/'), ('bob', '/'), ('ann', '/about')]
+        >>> len(list(visits | sketch(users, key=lambda visit: visit[0])))
+        3
+        >>> users.count()
+        2
+    """
+    add = sketch.add
+    for item in stdin:
+        add(item if key is None else key(item))
+        yield item
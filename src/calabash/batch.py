@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+"""
+Run pipelines in batch mode, passing lists of items between stages.
+
+In batch mode the source's output is cut into chunks, and batch-aware stages
+process a whole chunk per call. Any stage registered with
+:func:`~calabash.fusion.fusable` (which includes
+:func:`~calabash.common.map`, :func:`~calabash.common.filter`,
+:func:`~calabash.common.grep` and :func:`~calabash.common.sed`) is batch-aware
+automatically; other stages are fed one item at a time, with their output
+re-chunked afterwards. Use :meth:`~calabash.pipeline.PipeLine.batched` to turn
+batch mode on for a pipeline.
+"""
+
+import itertools
+import time
+
+from calabash import fusion
+
+
+#: Chunk size used when a pipeline asks for batch mode without specifying one.
+DEFAULT_SIZE = 1024
+
+_batchers = {}
+
+
+def batchable(batcher):
+    """
+    Register a batch-aware implementation of a pipeline generator.
+
+    `batcher` is called with the same arguments as the stage (minus `stdin`),
+    and should return a function which takes a list of input items and
+    returns a list of output items::
+
+        >>> from calabash.pipeline import pipe
+        >>> @pipe
+        ... @batchable(lambda: lambda chunk: [sum(chunk)])
+        ... def chunk_sums(stdin):
+        ...     for item in stdin:
+        ...         yield item
+        >>> list(xrange(10) | chunk_sums().batched(4))
+        [6, 22, 17]
+        >>> list(xrange(10) | chunk_sums())
+        [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+    """
+    def decorator(func):
+        _batchers[func] = batcher
+        return func
+    return decorator
+
+
+def batch_func_for(node, steps=None):
+    """
+    Return a function which runs `node` over a whole chunk, or ``None``.
+
+    If the fused `steps` for the node are already known, pass them in.
+    """
+    if getattr(node, 'kind', None) == 'stage' and node.func in _batchers:
+        return _batchers[node.func](*node.args, **node.kwargs)
+    if steps is None:
+        return None
+    return lambda chunk: _apply_steps(steps, chunk)
+
+
+def _apply_steps(steps, chunk):
+    for kind, func in steps:
+        if kind == 'map':
+            chunk = map(func, chunk)
+        elif kind == 'filter':
+            chunk = filter(func, chunk)
+        elif kind == 'filterfalse':
+            chunk = list(itertools.ifilterfalse(func, chunk))
+        elif kind == 'mapfilter':
+            chunk = [item for item in map(func, chunk)
+                     if item is not fusion.SKIP]
+        else:
+            raise ValueError("unknown step kind: %r" % (kind,))
+    return chunk
+
+
+class FixedSize(object):
+
+    """A chunk size which never changes."""
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError("batch size must be positive, not %r" % (size,))
+        self.size = size
+
+    def update(self, count, elapsed):
+        pass
+
+
+class AutoSize(object):
+
+    """
+    A chunk size which tunes itself while the pipeline runs.
+
+    Starting from `initial`, the size doubles for as long as doing so cuts
+    the time spent per item by at least `threshold` (as a fraction), and
+    settles on the best size seen as soon as it stops paying off. It will
+    never exceed `limit`.
+
+        >>> sizer = AutoSize(initial=16)
+        >>> sizer.update(16, 0.016)
+        >>> sizer.size
+        32
+        >>> sizer.update(32, 0.016)
+        >>> sizer.size
+        64
+        >>> sizer.update(64, 0.032)
+        >>> sizer.size
+        32
+        >>> sizer.update(32, 0.0)
+        >>> sizer.size
+        32
+    """
+
+    def __init__(self, initial=64, limit=65536, threshold=0.05):
+        self.size = initial
+        self.limit = limit
+        self.threshold = threshold
+        self.settled = False
+        self._best = None
+        self._best_size = initial
+
+    def update(self, count, elapsed):
+        """Record that it took `elapsed` seconds to process `count` items."""
+        if self.settled or count < self.size:
+            return
+        cost = elapsed / count
+        if self._best is None or cost < self._best * (1 - self.threshold):
+            self._best, self._best_size = cost, self.size
+            if self.size * 2 <= self.limit:
+                self.size *= 2
+                return
+        self.size = self._best_size
+        self.settled = True
+
+
+def sizer_for(size):
+    """Turn a batch size (an ``int`` or ``'auto'``) into a sizer object."""
+    if size == 'auto':
+        return AutoSize()
+    return FixedSize(size)
+
+
+def chunks(iterator, sizer):
+    """Cut an iterator into lists of ``sizer.size`` items."""
+    islice = itertools.islice
+    while True:
+        chunk = list(islice(iterator, sizer.size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _timed_chunks(iterator, sizer):
+    """Like :func:`chunks`, but report timings back to the sizer."""
+    clock = time.time
+    last = clock()
+    for chunk in chunks(iterator, sizer):
+        yield chunk
+        now = clock()
+        sizer.update(len(chunk), now - last)
+        last = now
+
+
+def run(node, size=DEFAULT_SIZE, stdin=None):
+    """
+    Iterate over a ``|`` chain in batch mode, optionally feeding it `stdin`.
+
+        >>> from calabash.common import map, filter
+        >>> from calabash.pipeline import pipe
+        >>> @pipe
+        ... def doubled(stdin):
+        ...     for item in stdin:
+        ...         yield item
+        ...         yield item
+        >>> pl = (xrange(6) | map(lambda x: x * 10) | doubled() |
+        ...       filter(lambda x: x % 20 == 0))
+        >>> list(run(pl.node, size=4))
+        [0, 0, 20, 20, 40, 40]
+    """
+    groups = fusion.plan(node, fed=stdin is not None)
+    if stdin is None:
+        stdin = groups.pop(0)[1]()
+    sizer = sizer_for(size)
+    batches = _timed_chunks(iter(stdin), sizer)
+    pending = []
+    for nodes, stage, steps in groups:
+        func = batch_func_for(stage, steps)
+        if func is None:
+            pending.append(stage)
+            continue
+        if pending:
+            batches = _per_item(pending, batches, sizer)
+            pending = []
+        batches = itertools.imap(func, batches)
+    if pending:
+        return _per_item(pending, batches, None)
+    return itertools.chain.from_iterable(batches)
+
+
+def _per_item(stages, batches, sizer):
+    """Run item-at-a-time stages between batches, re-chunking if needed."""
+    iterator = itertools.chain.from_iterable(batches)
+    for stage in stages:
+        iterator = stage(iterator)
+    if sizer is None:
+        return iterator
+    return chunks(iter(iterator), sizer)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+"""A small, thread-safe LRU cache."""
+
+from collections import OrderedDict
+import threading
+
+
+class LRUCache(object):
+
+    """
+    A mapping which holds at most `size` entries, forgetting the least
+    recently used one when it's full.
+
+        >>> cache = LRUCache(2)
+        >>> cache['a'] = 1
+        >>> cache['b'] = 2
+        >>> cache['a']
+        1
+        >>> cache['c'] = 3
+        >>> sorted(cache.keys())
+        ['a', 'c']
+
+    :meth:`get_or_create` looks a key up, calling a function to create (and
+    store) the value if it's missing::
+
+        >>> cache.get_or_create('d', lambda: 4)
+        4
+        >>> cache.get_or_create('d', lambda: 5)
+        4
+    """
+
+    def __init__(self, size=512):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = self._data.pop(key)
+            self._data[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def keys(self):
+        return self._data.keys()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def get_or_create(self, key, create):
+        try:
+            return self[key]
+        except KeyError:
+            value = create()
+            self[key] = value
+            return value
@@ -1,7 +1,15 @@
 # -*- coding: utf-8 -*-
 
+from functools import partial
+import itertools
 import re
+import sre_constants
+import sre_parse
 
+from calabash import sketches, spool
+from calabash.cache import LRUCache
+from calabash.fusion import apply_steps, fusable, spliceable, SKIP
+from calabash.graph import Stage
 from calabash.pipeline import pipe
 
 
@@ -27,12 +35,117 @@ def cat(*args, **kwargs):
         ...     if line.startswith('def cat'):
         ...          print repr(line)
         'def cat(*args, **kwargs):\n'
+
+    A few extra keyword arguments change how the file is read. Pass
+    ``mmap=True`` to memory-map the file and split lines straight out of the
+    mapping, which avoids going through a buffered reader for large local
+    files::
+
+        >>> [line for line in cat(src_file, mmap=True)
+        ...  if line.startswith('def cat')]
+        ['def cat(*args, **kwargs):\n']
+
+    Pass ``view=True`` (which implies `mmap`) to get zero-copy
+    :func:`buffer` views of the mapping instead of new strings. Slicing a
+    view, or calling :func:`str` on it, copies just that part::
+
+        >>> [str(line) for line in cat(src_file, view=True)
+        ...  if line[:7] == 'def cat']
+        ['def cat(*args, **kwargs):\n']
+
+    Pass `chunk_size` to read blocks of up to that many bytes instead of
+    lines, for stages which can work on big blocks of text at a time (a
+    block may end part-way through a line)::
+
+        >>> chunks = list(cat(src_file, chunk_size=1024))
+        >>> max(len(chunk) for chunk in chunks)
+        1024
+        >>> ''.join(chunks) == open(src_file).read()
+        True
+        >>> ''.join(cat(src_file, mmap=True, chunk_size=100)) == ''.join(chunks)
+        True
+
+    Finally, pass `encoding` to decode each line (or block) as it's read,
+    rather than up-front::
+
+        >>> type(next(iter(cat(src_file, encoding='utf-8'))))
+        <type 'unicode'>
+
+    A file which ends part-way through a character is an error, just as it
+    would be when decoding the whole thing at once::
+
+        >>> import tempfile
+        >>> with tempfile.NamedTemporaryFile() as truncated:
+        ...     truncated.write('ab\xc3')
+        ...     truncated.flush()
+        ...     list(cat(truncated.name, encoding='utf-8'))
+        Traceback (most recent call last):
+        ...
+        UnicodeDecodeError: 'utf8' codec can't decode byte 0xc3 in position 0: unexpected end of data
     """
-    return iter(open(*args, **kwargs))
+    use_mmap = kwargs.pop('mmap', False)
+    view = kwargs.pop('view', False)
+    chunk_size = kwargs.pop('chunk_size', None)
+    encoding = kwargs.pop('encoding', None)
+    if view and encoding is not None:
+        raise ValueError("can't decode zero-copy views")
+
+    if use_mmap or view:
+        output = _mmap_read(open(*args, **kwargs), chunk_size, view)
+    elif chunk_size:
+        infile = open(*args, **kwargs)
+        output = iter(lambda: infile.read(chunk_size), '')
+    else:
+        output = iter(open(*args, **kwargs))
+
+    if encoding is not None:
+        import codecs
+        decoder = codecs.getincrementaldecoder(encoding)()
+        output = itertools.chain(itertools.imap(decoder.decode, output),
+                                 _flush_decoder(decoder))
+    return output
+
+
+def _flush_decoder(decoder):
+    """Yield whatever's left in an incremental decoder, raising if it's bad."""
+    tail = decoder.decode('', True)
+    if tail:
+        yield tail
+
+
+def _mmap_read(infile, chunk_size, view):
+    """Memory-map a file, and iterate over its lines or blocks."""
+    import mmap
+    import os
+
+    with infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            return iter(())
+        mapped = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # The mapping is closed when it's garbage-collected, which can't happen
+    # until every view into it has gone too.
+    if chunk_size:
+        offsets = xrange(0, len(mapped), chunk_size)
+        if view:
+            return (buffer(mapped, offset, chunk_size) for offset in offsets)
+        return (mapped[offset:offset + chunk_size] for offset in offsets)
+    if view:
+        return _mmap_views(mapped)
+    return iter(mapped.readline, '')
+
+
+def _mmap_views(mapped):
+    find, size = mapped.find, len(mapped)
+    start = 0
+    while start < size:
+        end = find('\n', start) + 1 or size
+        yield buffer(mapped, start, end - start)
+        start = end
 
 
 @pipe
-def curl(url):
+def curl(url, pool=None, chunk_size=65536, headers=None):
     """
     Fetch a URL, yielding output line-by-line.
 
@@ -41,9 +154,35 @@ def curl(url):
         ...     print line,
         This is free and unencumbered software released into the public domain.
         ...
+
+    HTTP and HTTPS URLs are fetched over keep-alive connections borrowed
+    from a :class:`~calabash.connections.ConnectionPool` (pass your own as
+    `pool`, or a shared default is used), with gzip-encoded responses
+    decoded on the fly. The body is read `chunk_size` bytes at a time, and
+    split into lines. Any other kind of URL, or one which the environment
+    says to fetch through a proxy (``http_proxy`` and so on), is opened with
+    :func:`urllib2.urlopen`. See :mod:`calabash.connections` for examples.
     """
+    import urlparse
+
+    parts = urlparse.urlsplit(url)
+    if parts.scheme in ('http', 'https') and not _proxied(parts):
+        from calabash.connections import fetch
+        return _split_lines(fetch(url, pool=pool, chunk_size=chunk_size,
+                                  headers=headers))
+    return _urlopen_lines(url, headers)
+
+
+def _proxied(parts):
+    """True if the environment sets a proxy for a split URL."""
+    import urllib
+    return (parts.scheme in urllib.getproxies() and
+            not urllib.proxy_bypass(parts.hostname or ''))
+
+
+def _urlopen_lines(url, headers=None):
     import urllib2
-    conn = urllib2.urlopen(url)
+    conn = urllib2.urlopen(urllib2.Request(url, headers=headers or {}))
     try:
         line = conn.readline()
         while line:
@@ -54,22 +193,491 @@ def curl(url):
 
 
 @pipe
-def grep(stdin, pattern_src):
+def curl_many(stdin, workers=8, per_host=2, ordered=True, pool=None,
+              headers=None, backlog=None):
+    """
+    Fetch each URL on stdin concurrently, yielding ``(url, body)`` pairs.
+
+    Up to `workers` URLs are fetched at once, but no more than `per_host` from
+    any one host. Results come out in input order unless ``ordered=False``,
+    in which case they're yielded as soon as each one finishes.
+    Connections come from a :class:`~calabash.connections.ConnectionPool`,
+    just as with :func:`curl`. See :mod:`calabash.connections` for examples.
+
+    A URL whose host already has `per_host` fetches going is held back,
+    while URLs after it for other hosts go ahead, so a run of URLs for one
+    host doesn't hold up the rest. At most `backlog` URLs (by default, 16
+    per worker) are held back at once; past that, reading stops until some
+    have been fetched.
+    """
+    import collections
+    import Queue
+    import sys
+    import urlparse
+    from multiprocessing.pool import ThreadPool
+
+    if backlog is None:
+        backlog = workers * 16
+
+    def fetch_one(index, url, host):
+        try:
+            body = ''.join(curl(url, pool=pool, headers=headers))
+            return index, url, host, body, None
+        except Exception:
+            return index, url, host, None, sys.exc_info()
+
+    done = Queue.Queue()
+    threads = ThreadPool(workers)
+    active = collections.defaultdict(int)
+    waiting = collections.defaultdict(collections.deque)
+    urls = enumerate(stdin)
+    fetching = held = 0
+    results, next_index = {}, 0
+
+    def start(index, url, host):
+        active[host] += 1
+        threads.apply_async(fetch_one, (index, url, host),
+                            callback=done.put)
+
+    try:
+        while True:
+            while urls is not None and fetching < workers and held < backlog:
+                try:
+                    index, url = next(urls)
+                except StopIteration:
+                    urls = None
+                    break
+                host = urlparse.urlsplit(url).netloc
+                if active[host] < per_host:
+                    start(index, url, host)
+                    fetching += 1
+                else:
+                    waiting[host].append((index, url))
+                    held += 1
+            # Nothing can be held back without a fetch for its host going.
+            if not fetching:
+                return
+
+            index, url, host, body, error = done.get()
+            fetching -= 1
+            active[host] -= 1
+            if waiting[host]:
+                start(*waiting[host].popleft() + (host,))
+                fetching += 1
+                held -= 1
+            elif not active[host]:
+                del waiting[host], active[host]
+            if error is not None:
+                raise error[0], error[1], error[2]
+
+            if not ordered:
+                yield url, body
+                continue
+            results[index] = url, body
+            while next_index in results:
+                yield results.pop(next_index)
+                next_index += 1
+    finally:
+        threads.terminate()
+
+
+_METACHARACTERS = frozenset('.^$*+?{}[]\\|()')
+
+
+def _is_literal(pattern_src):
+    return (isinstance(pattern_src, basestring) and
+            not _METACHARACTERS.intersection(pattern_src))
+
+
+def _trie_regex(words):
+    """
+    Build a regex matching any of `words`, with common prefixes factored out.
+
+    This lets the regex engine walk a trie of the words (much like an
+    Aho-Corasick automaton) instead of trying every alternative in turn at
+    each position.
+
+        >>> _trie_regex(['abc', 'abd', 'ab', 'x'])
+        '(?:ab(?:c|d)?|x)'
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node):
+        optional = '' in node
+        branches = [re.escape(char) + build(node[char])
+                    for char in sorted(node) if char]
+        if not branches:
+            return ''
+        if len(branches) == 1:
+            regex = branches[0]
+            if optional and len(regex) > 1:
+                regex = '(?:%s)' % regex
+        else:
+            regex = '(?:%s)' % '|'.join(branches)
+        return regex + '?' if optional else regex
+    return build(trie)
+
+
+def _patterns(pattern_src):
+    if isinstance(pattern_src, basestring) or hasattr(pattern_src, 'search'):
+        return [pattern_src]
+    return list(pattern_src)
+
+
+#: Compiled regexes and parsed replacement templates, shared by every
+#: :func:`grep` and :func:`sed` in the process. Set ``pattern_cache.size`` to
+#: change how many are kept.
+pattern_cache = LRUCache(512)
+
+
+def _regex_for(patterns, flags=0):
+    """Compile a list of patterns into a regex matching any one of them."""
+    return pattern_cache.get_or_create(
+        ('regex', tuple(patterns), flags),
+        lambda: _compile_regex(patterns, flags))
+
+
+def _compile_regex(patterns, flags):
+    if len(patterns) == 1:
+        pattern = patterns[0]
+        if hasattr(pattern, 'search'):
+            return re.compile(pattern.pattern, pattern.flags | flags)
+        if _is_literal(pattern):
+            pattern = re.escape(pattern)
+        return re.compile(pattern, flags)
+    if all(_is_literal(pattern) for pattern in patterns):
+        return re.compile(_trie_regex(patterns), flags)
+    return re.compile('|'.join('(?:%s)' % getattr(pattern, 'pattern', pattern)
+                               for pattern in patterns), flags)
+
+
+def _matcher(pattern_src):
+    """
+    Return a predicate for lines which match a pattern (or any of several).
+
+    Plain literals are matched with substring search, lists of literals with
+    a single trie-shaped regex, and anything else with :func:`re.search`.
+    Substring search is only used on lines of the same type as the literal,
+    since ``in`` would decode a byte string with non-ASCII characters (and
+    fail) to look for a unicode literal.
+    """
+    patterns = _patterns(pattern_src)
+    if not patterns:
+        return lambda line: False
+    search = _regex_for(patterns).search
+    if len(patterns) == 1 and _is_literal(patterns[0]):
+        literal = patterns[0]
+        kind = type(literal)
+        def match(line):
+            if type(line) is kind:
+                return literal in line
+            return search(line)
+        return match
+    return search
+
+
+def _grep_steps(pattern_src, invert=False, count=False, max_count=None,
+                block=False):
+    if count or max_count is not None or block:
+        return None
+    return [('filterfalse' if invert else 'filter', _matcher(pattern_src))]
+
+
+@pipe
+@fusable(_grep_steps)
+def grep(stdin, pattern_src, invert=False, count=False, max_count=None,
+         block=False):
     """
     Filter strings on stdin for the given regex (uses :func:`re.search`).
 
         >>> list(iter(['cat', 'cabbage', 'conundrum', 'cathedral']) | grep(r'^ca'))
         ['cat', 'cabbage', 'cathedral']
+
+    Patterns without any regex metacharacters are matched with a plain
+    substring search, where the line is the same type (``str`` or
+    ``unicode``) as the pattern, so mixing the two works just as it does
+    with :func:`re.search`::
+
+        >>> list(['caf\xc3\xa9', 'plain'] | grep(u'pla'))
+        ['plain']
+
+    You can also pass a list of patterns, to match lines
+    containing any of them; a list of literal strings (such as a few hundred
+    IDs) is compiled into a single trie-shaped regex, which is much faster
+    than a long alternation::
+
+        >>> words = ['cat', 'cabbage', 'conundrum', 'cathedral']
+        >>> list(words | grep(['dral', 'bba']))
+        ['cabbage', 'cathedral']
+
+    Like the UNIX utility, `invert` yields the lines which *don't* match,
+    `count` yields the number of matching lines instead of the lines
+    themselves, and `max_count` stops reading input after that many matches::
+
+        >>> list(words | grep('^ca', invert=True))
+        ['conundrum']
+        >>> list(words | grep('^ca', count=True))
+        [3]
+        >>> list(iter(lambda: 'yes', None) | grep('y', max_count=2))
+        ['yes', 'yes']
+
+    With ``block=True``, stdin is treated as one continuous stream of text,
+    cut into pieces of any size (such as the blocks from
+    ``cat(..., chunk_size=N)``, or plain lines), and the regex is run over
+    big buffers of it at a time. Only the lines around each match are ever
+    split out, which is much faster when matches are sparse. The output is
+    the same as line-by-line mode::
+
+        >>> text = ['cat\\ncabb', 'age\\nconundrum\\n', 'cathedral']
+        >>> list(text | grep(r'^ca', block=True))
+        ['cat\\n', 'cabbage\\n', 'cathedral']
+        >>> list(text | grep(r'^ca', block=True, invert=True))
+        ['conundrum\\n']
+
+    For a few patterns, whose matches could be missed in a big buffer, block
+    mode splits the input into lines first: ones using ``\\A``, ``\\Z``,
+    ``\\B`` or lookarounds, and ones which match a line's ``'\\n'`` and then
+    check what comes after it, like this one::
+
+        >>> list(['abc\\nde', 'f\\n'] | grep(r'\\s$', block=True))
+        ['abc\\n', 'def\\n']
+    """
+    if block:
+        return _grep_blocks(stdin, _patterns(pattern_src), invert, count,
+                            max_count)
+    return _grep_lines(stdin, pattern_src, invert, count, max_count)
+
+
+def _grep_lines(stdin, pattern_src, invert, count, max_count):
+    match = _matcher(pattern_src)
+    if invert:
+        lines = itertools.ifilterfalse(match, stdin)
+    else:
+        lines = itertools.ifilter(match, stdin)
+    if max_count is not None:
+        lines = itertools.islice(lines, max_count)
+    if count:
+        return _count(lines)
+    return lines
+
+
+_BLOCK_SIZE = 1 << 16
+
+
+def _grep_blocks(stdin, patterns, invert, count, max_count):
+    """Run :func:`grep` over big buffers of text, rather than line-by-line."""
+    if any(_needs_lines(pattern) for pattern in patterns):
+        return _grep_lines(_split_lines(stdin), patterns, invert, count,
+                           max_count)
+
+    lines = _scan_blocks(stdin, patterns, invert)
+    if max_count is not None:
+        lines = itertools.islice(lines, max_count)
+    if count:
+        return _count(lines)
+    return lines
+
+
+# Categories (as in ``\s``) which include ``'\n'``.
+_NEWLINE_CATEGORIES = frozenset([
+    sre_constants.CATEGORY_SPACE, sre_constants.CATEGORY_NOT_WORD,
+    sre_constants.CATEGORY_NOT_DIGIT, sre_constants.CATEGORY_LINEBREAK])
+
+
+def _needs_lines(pattern):
     """
-    pattern = re.compile(pattern_src)
-    for line in stdin:
-        if pattern.search(line):
+    True if `pattern` might match a line on its own, but not within a buffer
+    of many lines, so block mode can't use it.
+
+    Matches found in a buffer are checked against their own line, which
+    weeds out any extra ones, but some matches would be missed altogether.
+    ``\A`` and ``\Z`` anchor to the start and end of the whole buffer. Past
+    the end of a line (after its ``'\n'``), ``\B`` and lookarounds see the
+    start of the next line rather than the end of the string, and so do
+    lookbehinds at the start of a line. And once a pattern has matched a
+    line's ``'\n'``, so do ``$`` and ``\b``.
+    """
+    try:
+        parsed = sre_parse.parse(getattr(pattern, 'pattern', pattern),
+                                 getattr(pattern, 'flags', 0))
+    except sre_constants.error:
+        return True
+    dotall = parsed.pattern.flags & re.DOTALL
+    newline = context = False
+    subpatterns = [parsed]
+    while subpatterns:
+        for op, arg in subpatterns.pop():
+            if op == sre_constants.AT:
+                if arg in (sre_constants.AT_BEGINNING_STRING,
+                           sre_constants.AT_END_STRING,
+                           sre_constants.AT_NON_BOUNDARY):
+                    return True
+                context = context or arg != sre_constants.AT_BEGINNING
+            elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+                return True
+            elif op == sre_constants.LITERAL:
+                newline = newline or arg == 10
+            elif op == sre_constants.NOT_LITERAL:
+                newline = newline or arg != 10
+            elif op == sre_constants.ANY:
+                newline = newline or bool(dotall)
+            elif op == sre_constants.IN:
+                newline = newline or _set_has_newline(arg)
+            elif op == sre_constants.BRANCH:
+                subpatterns.extend(arg[1])
+            elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+                subpatterns.append(arg[2])
+            elif op == sre_constants.SUBPATTERN:
+                subpatterns.append(arg[-1])
+            elif op == sre_constants.GROUPREF_EXISTS:
+                subpatterns.extend(branch for branch in arg[1:] if branch)
+    return newline and context
+
+
+def _set_has_newline(items):
+    """True if a parsed character set (as in ``[^a-z]``) includes ``'\n'``."""
+    negate = found = False
+    for op, arg in items:
+        if op == sre_constants.NEGATE:
+            negate = True
+        elif op == sre_constants.LITERAL:
+            found = found or arg == 10
+        elif op == sre_constants.RANGE:
+            found = found or arg[0] <= 10 <= arg[1]
+        elif op == sre_constants.CATEGORY:
+            found = found or arg in _NEWLINE_CATEGORIES
+    return found != negate
+
+
+def _scan_blocks(stdin, patterns, invert):
+    if not patterns:
+        find = lambda buf, pos, end: -1
+    else:
+        search = _regex_for(patterns, re.MULTILINE).search
+        def find(buf, pos, end):
+            match = search(buf, pos, end)
+            return -1 if match is None else match.start()
+        if len(patterns) == 1 and _is_literal(patterns[0]):
+            literal = patterns[0]
+            kind, regex_find = type(literal), find
+            def find(buf, pos, end):
+                if type(buf) is kind:
+                    return buf.find(literal, pos, end)
+                return regex_find(buf, pos, end)
+    match_line = _matcher(patterns)
+
+    def scan(buf, end, final=False):
+        # Each match is checked against its own line, as a pattern which can
+        # match newlines may have run on from an earlier line; either way,
+        # scanning resumes at the start of the next line.
+        pos = 0
+        while pos < end:
+            found = find(buf, pos, end)
+            if found < 0 or (found == end and not final):
+                # An empty match at `end` belongs to the next line.
+                break
+            start = buf.rfind('\n', 0, found) + 1
+            stop = buf.find('\n', found, end) + 1 or end
+            line = buf[start:stop]
+            if invert:
+                for other in _readlines(buf[pos:start]):
+                    yield other
+                if not match_line(line):
+                    yield line
+            elif match_line(line):
+                yield line
+            pos = stop
+        if invert and pos < end:
+            for other in _readlines(buf[pos:end]):
+                yield other
+
+    # As in _split_lines, an unfinished line is only joined up once it's
+    # finished, rather than copied again with every buffer.
+    pieces = []
+    for buf in _gather(stdin, _BLOCK_SIZE):
+        if buf.find('\n') < 0:
+            pieces.append(buf)
+            continue
+        if pieces:
+            pieces.append(buf)
+            buf = ''.join(pieces)
+            del pieces[:]
+        end = buf.rfind('\n') + 1
+        if end < len(buf):
+            pieces.append(buf[end:])
+        for line in scan(buf, end):
+            yield line
+    partial = ''.join(pieces)
+    if partial:
+        for line in scan(partial, len(partial), final=True):
             yield line
 
 
-@pipe
-def sed(stdin, pattern_src, replacement, exclusive=False):
+def _gather(pieces, size):
+    """Join small pieces of text together into buffers of at least `size`."""
+    buf, length = [], 0
+    for piece in pieces:
+        buf.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(buf)
+            buf, length = [], 0
+    if buf:
+        yield ''.join(buf)
+
+
+def _count(iterable):
+    yield sum(1 for _ in iterable)
+
+
+def _sed_steps(pattern_src, replacement, exclusive=False, count=1,
+               literal=False):
+    pattern = _regex_for(_patterns(pattern_src))
+    repl = _replacement(pattern, replacement, literal)
+    if exclusive:
+        subn = pattern.subn
+        def substitute(line):
+            line, subs = subn(repl, line, count)
+            return line if subs else SKIP
+        return [('mapfilter', substitute)]
+    return [('map', partial(pattern.sub, repl, count=count))]
+
+
+def _replacement(pattern, replacement, literal):
+    """
+    Turn a replacement template into the cheapest equivalent `repl`.
+
+    Templates without backslashes are handed straight to the regex engine,
+    which treats them as literals. Anything else is parsed once (and cached),
+    rather than on every call to :meth:`re.RegexObject.sub`.
     """
+    import sre_parse
+
+    if '\\' not in replacement:
+        return replacement
+    if literal:
+        return lambda match: replacement
+
+    template = pattern_cache.get_or_create(
+        ('template', pattern, replacement),
+        lambda: sre_parse.parse_template(replacement, pattern))
+    groups, literals = template
+    if not groups:
+        text = replacement[:0].join(literals)
+        return lambda match: text
+    return partial(sre_parse.expand_template, template)
+
+
+@pipe
+@fusable(_sed_steps)
+def sed(stdin, pattern_src, replacement, exclusive=False, count=1,
+        literal=False):
+    r"""
     Apply :func:`re.sub` to each line on stdin with the given pattern/repl.
 
         >>> list(iter(['cat', 'cabbage']) | sed(r'^ca', 'fu'))
@@ -83,16 +691,29 @@ def sed(stdin, pattern_src, replacement, exclusive=False):
         ['fut', 'nomatch']
         >>> list(iter(['cat', 'nomatch']) | sed(r'^ca', 'fu', exclusive=True))
         ['fut']
+
+    Only the first match on each line is replaced, unless you pass a
+    different `count`; as with :func:`re.sub`, ``count=0`` replaces every
+    match (like the ``g`` flag to ``s///`` in UNIX sed)::
+
+        >>> list(['banana'] | sed('a', 'o', count=0))
+        ['bonono']
+
+    The replacement may refer to groups from the pattern, like ``\1`` or
+    ``\g<name>``. Pass ``literal=True`` to insert it exactly as given::
+
+        >>> list(['banana'] | sed(r'(an)', r'<\1>'))
+        ['b<an>ana']
+        >>> list(['banana'] | sed(r'(an)', r'<\1>', literal=True))
+        ['b<\\1>ana']
+
+    Compiled patterns and parsed replacements are kept in
+    :data:`pattern_cache`, so building the same :func:`sed` (or
+    :func:`grep`) over and over doesn't recompile anything.
     """
-    pattern = re.compile(pattern_src)
-    for line in stdin:
-        match = pattern.search(line)
-        if match:
-            yield (line[:match.start()] +
-                   match.expand(replacement) +
-                   line[match.end():])
-        elif not exclusive:
-            yield line
+    return apply_steps(
+        _sed_steps(pattern_src, replacement, exclusive, count, literal),
+        iter(stdin))
 
 
 @pipe
@@ -112,6 +733,7 @@ def pretty_printer(stdin, **kwargs):
 
 
 @pipe
+@fusable(lambda func: [('map', func)])
 def map(stdin, func):
     """
     Map each item on stdin through the given function.
@@ -124,6 +746,7 @@ def map(stdin, func):
 
 
 @pipe
+@fusable(lambda predicate: [('filter', predicate)])
 def filter(stdin, predicate):
     """
     Only pass through items for which `predicate(item)` is truthy.
@@ -137,7 +760,230 @@ def filter(stdin, predicate):
 
 
 @pipe
-def sh(stdin, command=None, check_success=False):
+def uniq(stdin, key=None, seen=None):
+    """
+    Drop items which have been seen before, keeping the rest in order.
+
+    Unlike ``uniq``, duplicates needn't be next to each other, so there's no
+    need to ``sort -u`` first. Items are compared by ``key(item)`` if `key`
+    is given, and the keys seen so far are kept in `seen`, a new set unless
+    you pass your own::
+
+        >>> list('mississippi' | uniq())
+        ['m', 'i', 's', 'p']
+        >>> list(['a', 'B', 'b', 'A', 'c'] | uniq(key=str.lower))
+        ['a', 'B', 'c']
+
+    A set has to hold every distinct key. For streams with more distinct
+    keys than will fit in memory, pass a
+    :class:`~calabash.sketches.BloomFilter` instead: it uses a fixed amount
+    of memory, never lets a duplicate through, but wrongly drops a small
+    fraction of new items. Keep hold of it to see how much memory it uses,
+    and what that fraction is likely to be::
+
+        >>> from calabash.sketches import BloomFilter
+        >>> seen = BloomFilter(capacity=1000, error_rate=0.001)
+        >>> sum(1 for _ in xrange(500) | map(lambda n: n % 100) |
+        ...                uniq(seen=seen))
+        100
+        >>> seen.nbytes, seen.false_positive_rate() < 1e-6
+        (1798, True)
+    """
+    if seen is None:
+        seen = set()
+    if isinstance(seen, sketches.BloomFilter):
+        add = seen.add
+        for item in stdin:
+            if add(item if key is None else key(item)):
+                yield item
+        return
+    add = seen.add
+    for item in stdin:
+        value = item if key is None else key(item)
+        if value not in seen:
+            add(value)
+            yield item
+
+
+#: Most sorted runs :func:`sort` merges at once (each holds a file open).
+MERGE_FAN_IN = 64
+
+
+@pipe
+def sort(stdin, key=None, reverse=False, unique=False,
+         spill_threshold=spool.DEFAULT_THRESHOLD):
+    """
+    Sort the input. Like ``sort``, but for any Python objects.
+
+    `key` and `reverse` work as for :func:`sorted`, and the sort is stable.
+    With `unique`, only the first of each set of items with equal keys is
+    kept, like ``sort -u``::
+
+        >>> list('banana' | sort())
+        ['a', 'a', 'a', 'b', 'n', 'n']
+        >>> ''.join('banana' | sort(reverse=True, unique=True))
+        'nba'
+
+    Up to `spill_threshold` items at a time are sorted in memory. Past that,
+    each sorted batch is written to a compressed temporary file (see
+    :class:`~calabash.spool.Run`), so items must be picklable, and the
+    batches are merged as the output is read::
+
+        >>> list(xrange(10, 0, -1) | sort(key=lambda n: n % 3,
+        ...                               spill_threshold=3))
+        [9, 6, 3, 10, 7, 4, 1, 8, 5, 2]
+    """
+    stdin = iter(stdin)
+    islice = itertools.islice
+    runs, carry = [], []
+    try:
+        while True:
+            batch = carry + list(islice(stdin, spill_threshold - len(carry)))
+            batch.sort(key=key, reverse=reverse)
+            if len(batch) < spill_threshold:
+                break
+            try:
+                carry = [next(stdin)]
+            except StopIteration:
+                break
+            runs.append(spool.Run(batch))
+            del batch
+        # The last batch is merged straight from memory.
+        sources = runs + [batch]
+        while len(sources) > MERGE_FAN_IN:
+            # Merge the earliest runs first, to keep the sort stable.
+            merging = sources[:MERGE_FAN_IN]
+            run = spool.Run(_merged(merging, key, reverse))
+            for merged in merging:
+                merged.close()
+            runs.append(run)
+            sources = [run] + sources[MERGE_FAN_IN:]
+        if len(sources) == 1:
+            output = iter(batch)
+        else:
+            output = _merged(sources, key, reverse)
+        if unique:
+            output = _unique(output, key)
+        for item in output:
+            yield item
+    finally:
+        for run in runs:
+            run.close()
+
+
+@pipe
+def merge(*sources, **kwargs):
+    """
+    Merge pipelines (or other iterables) which are already sorted.
+
+    Like ``sort -m``, only one item from each source is held at a time.
+    `key` and `reverse` say how the sources are sorted, as for :func:`sort`;
+    when items are equal, those from earlier sources come first::
+
+        >>> list(merge([1, 4, 9], xrange(0, 10, 3)))
+        [0, 1, 3, 4, 6, 9, 9]
+
+    When it has input, that's merged with the other sources::
+
+        >>> list(echo('b') | merge('ac', 'd'))
+        ['a', 'b', 'c', 'd']
+    """
+    key = kwargs.pop('key', None)
+    reverse = kwargs.pop('reverse', False)
+    if kwargs:
+        raise TypeError("merge() got an unexpected keyword argument %r" %
+                        (kwargs.keys()[0],))
+    return _merged(sources, key, reverse)
+
+
+class _Reversed(object):
+
+    """Wraps a sort key, so that a min-heap of them gives the largest."""
+
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+
+def _merged(sources, key=None, reverse=False):
+    """
+    Merge sorted iterables, keeping items from earlier ones first on ties.
+
+    Each heap entry is ``[key, index, item, iterator]``, and there's only
+    ever one entry per source, so items themselves are never compared.
+    """
+    import heapq
+
+    def sort_key(item):
+        if key is not None:
+            item = key(item)
+        if reverse:
+            item = _Reversed(item)
+        return item
+
+    heap = []
+    for index, source in enumerate(sources):
+        iterator = iter(source)
+        for item in iterator:
+            heap.append([sort_key(item), index, item, iterator])
+            break
+    heapq.heapify(heap)
+    heapreplace, heappop = heapq.heapreplace, heapq.heappop
+    while len(heap) > 1:
+        entry = heap[0]
+        yield entry[2]
+        for item in entry[3]:
+            entry[0], entry[2] = sort_key(item), item
+            heapreplace(heap, entry)
+            break
+        else:
+            heappop(heap)
+    if heap:
+        yield heap[0][2]
+        for item in heap[0][3]:
+            yield item
+
+
+def _unique(items, key=None):
+    items = iter(items)
+    for previous in items:
+        yield previous
+        if key is not None:
+            previous = key(previous)
+        for item in items:
+            current = item if key is None else key(item)
+            if current != previous:
+                yield item
+                previous = current
+
+
+def _join_sh(nodes, head):
+    """Splice adjacent :func:`sh` stages into one chain of processes."""
+    import inspect
+
+    specs = []
+    for index, node in enumerate(nodes):
+        args = node.args
+        if index > 0 or not head:
+            args = (None,) + args
+        callargs = inspect.getcallargs(node.func, *args, **node.kwargs)
+        command = callargs['command']
+        if command is None:
+            command = callargs['stdin']
+        specs.append((command, callargs['check_success'], callargs['stderr']))
+    return Stage(_sh_chain, (specs,))
+
+
+@pipe
+@spliceable(_join_sh)
+def sh(stdin, command=None, check_success=False, stderr=None):
     r"""
     Run a shell command, send it input, and produce its output.
 
@@ -155,27 +1001,204 @@ def sh(stdin, command=None, check_success=False):
         Traceback (most recent call last):
         ...
         CalledProcessError: Command '['false']' returned non-zero exit status 1
+
+    Input is written to the command from a background thread while its
+    output is read, so commands which produce output as they go (like
+    ``grep``, ``sed`` or ``tr``) stream lines downstream as soon as they're
+    printed, and input larger than the OS pipe buffer can't deadlock::
+
+        >>> lines = ('line %d\n' % i for i in xrange(100000))
+        >>> len(list(lines | sh('cat')))
+        100000
+
+    By default the command's stderr goes wherever ours does. Pass an object
+    with an ``append()`` method as `stderr` (such as a list, or a
+    :class:`collections.deque` with a `maxlen` to keep memory bounded) to
+    capture it line-by-line instead. Captured stderr is also attached as the
+    `output` of any :exc:`~subprocess.CalledProcessError`::
+
+        >>> errors = []
+        >>> list(sh('sh -c "echo oops >&2"', stderr=errors))
+        []
+        >>> errors
+        ['oops\n']
+
+    Adjacent :func:`sh` stages are spliced together when the pipeline runs,
+    so each command's stdout is connected straight to the next one's stdin,
+    just like in a real shell, and only the two ends of the chain pass
+    through Python. The exit status of every command is still checked if it
+    was given `check_success`::
+
+        >>> from calabash.fusion import explain
+        >>> pl = sh('printf "b\na\nb\n"') | sh('sort') | sh('uniq -c')
+        >>> explain(pl)
+        '{sh | sh | sh}'
+        >>> [line.split() for line in pl]
+        [['1', 'a'], ['2', 'b']]
+        >>> list(sh('echo') | sh('false', check_success=True) | sh('cat'))
+        Traceback (most recent call last):
+        ...
+        CalledProcessError: Command '['false']' returned non-zero exit status 1
+    """
+    if command is None:
+        stdin, command = None, stdin
+    return _run_commands(stdin, [(command, check_success, stderr)])
+
+
+def _sh_chain(stdin, specs=None):
+    if specs is None:
+        stdin, specs = None, stdin
+    return _run_commands(stdin, specs)
+
+
+def _run_commands(stdin, specs):
     """
+    Run a chain of commands, each one's stdout connected to the next's stdin.
+
+    `specs` is a list of ``(command, check_success, stderr)`` tuples, as
+    passed to :func:`sh`. Only `stdin` and the last command's output pass
+    through Python.
+    """
+    import os
     import subprocess
     import shlex
+    import threading
 
-    if command is None:
-        stdin, command = (), stdin
+    procs = []
+    upstream = subprocess.PIPE
+    try:
+        for command, check_success, stderr in specs:
+            if isinstance(command, basestring):
+                command = shlex.split(command)
+            proc = subprocess.Popen(command,
+                    stdin=upstream,
+                    stdout=subprocess.PIPE,
+                    stderr=None if stderr is None else subprocess.PIPE,
+                    close_fds=True,
+                    preexec_fn=_restore_sigpipe)
+            if upstream is not subprocess.PIPE:
+                upstream.close()
+            upstream = proc.stdout
+            procs.append((proc, command, check_success, stderr))
+    except:
+        for proc, _, _, _ in procs:
+            proc.kill()
+            proc.wait()
+        raise
 
-    if isinstance(command, basestring):
-        command = shlex.split(command)
+    threads = []
+    def spawn(target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
 
-    pipe = subprocess.Popen(command,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE)
+    feed_error = []
+    first = procs[0][0]
+    if stdin is None:
+        first.stdin.close()
+    else:
+        spawn(_feed, stdin, first.stdin, feed_error)
+    for proc, _, _, stderr in procs:
+        if stderr is not None:
+            spawn(_drain, proc.stderr, stderr)
 
+    fd = upstream.fileno()
+    finished = False
     try:
-        for line in stdin:
-            pipe.stdin.write(line)
-        pipe.stdin.close()
-        for line in pipe.stdout:
+        for line in _split_lines(iter(lambda: os.read(fd, 65536), '')):
             yield line
+        finished = True
     finally:
-        result = pipe.wait()
+        # Closing stdout first means a command we stopped reading early gets
+        # SIGPIPE (see _restore_sigpipe), rather than blocking forever on a
+        # full pipe. But one still waiting for input might never write again
+        # (if whatever feeds it is stalled), so stop the lot.
+        upstream.close()
+        if not finished:
+            for proc, _, _, _ in procs:
+                if proc.poll() is None:
+                    proc.terminate()
+        results = [proc.wait() for proc, _, _, _ in procs]
+        for thread in threads:
+            # The feeder may be stuck waiting on stdin; it's a daemon thread,
+            # and gives up once stdin yields again.
+            thread.join(None if finished else 0.1)
+
+    if feed_error:
+        raise feed_error[0], feed_error[1], feed_error[2]
+    for result, (_, command, check_success, stderr) in zip(results, procs):
         if check_success and result != 0:
-            raise subprocess.CalledProcessError(result, command)
+            output = None if stderr is None else ''.join(stderr)
+            raise subprocess.CalledProcessError(result, command, output)
+
+
+def _restore_sigpipe():
+    """
+    Let a child process be killed by SIGPIPE, as it would be from a shell.
+
+    Python ignores SIGPIPE, and children inherit that, so without this a
+    command whose output we stop reading would complain about a broken pipe
+    (or, if it ignores write errors, never exit).
+    """
+    import signal
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+def _feed(stdin, outfile, error):
+    """Write every line of `stdin` to `outfile`, then close it."""
+    import errno
+    import sys
+
+    try:
+        for line in stdin:
+            outfile.write(line)
+    except IOError, exc:
+        if exc.errno != errno.EPIPE:
+            error.extend(sys.exc_info())
+    except Exception:
+        error.extend(sys.exc_info())
+    finally:
+        try:
+            outfile.close()
+        except IOError:
+            pass
+
+
+def _drain(infile, lines):
+    """Append every line read from `infile` to `lines`."""
+    for line in iter(infile.readline, ''):
+        lines.append(line)
+    infile.close()
+
+
+def _readlines(text):
+    """Split text into lines, breaking only after ``'\n'``."""
+    if isinstance(text, unicode):
+        from io import StringIO
+    else:
+        from cStringIO import StringIO
+    return StringIO(text).readlines()
+
+
+def _split_lines(chunks):
+    """Re-cut a stream of strings into ``'\n'``-terminated lines."""
+    # Pieces of an unfinished line are only joined once it's finished, so a
+    # line longer than many chunks isn't copied again for every one.
+    pieces = []
+    for chunk in chunks:
+        if chunk.find('\n') < 0:
+            pieces.append(chunk)
+            continue
+        if pieces:
+            pieces.append(chunk)
+            chunk = ''.join(pieces)
+            del pieces[:]
+        lines = _readlines(chunk)
+        if not lines[-1].endswith('\n'):
+            pieces.append(lines.pop())
+        for line in lines:
+            yield line
+    partial = ''.join(pieces)
+    if partial:
+        yield partial
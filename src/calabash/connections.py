@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+r"""
+Pooled, keep-alive HTTP connections for :func:`~calabash.common.curl`.
+
+Rather than opening a new connection for every URL, :func:`fetch` borrows an
+idle HTTP/1.1 connection to the same host from a :class:`ConnectionPool`,
+and hands it back once the response has been read in full. Responses are read
+in large chunks, and gzip- or deflate-encoded bodies are decoded as they
+stream in.
+
+Here's a small local server to try it out against::
+
+    >>> import BaseHTTPServer, SocketServer, threading, zlib
+    >>> class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ...     protocol_version = 'HTTP/1.1'
+    ...     def do_GET(self):
+    ...         body = ''.join('%s %d\n' % (self.path, i) for i in range(3))
+    ...         if self.path == '/whoami':
+    ...             body = self.headers.get('Authorization', '')
+    ...         self.send_response(200)
+    ...         if 'gzip' in self.headers.get('Accept-Encoding', ''):
+    ...             packer = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    ...             body = packer.compress(body) + packer.flush()
+    ...             self.send_header('Content-Encoding', 'gzip')
+    ...         self.send_header('Content-Length', str(len(body)))
+    ...         self.end_headers()
+    ...         self.wfile.write(body)
+    ...     def log_message(self, *args):
+    ...         pass
+    >>> class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    ...     daemon_threads = True
+    >>> server = Server(('127.0.0.1', 0), Handler)
+    >>> thread = threading.Thread(target=server.serve_forever)
+    >>> thread.daemon = True
+    >>> thread.start()
+    >>> base = 'http://127.0.0.1:%d' % server.server_address[1]
+
+The body comes back decompressed, and the second request reuses the first
+one's connection::
+
+    >>> pool = ConnectionPool()
+    >>> ''.join(fetch(base + '/a', pool=pool))
+    '/a 0\n/a 1\n/a 2\n'
+    >>> ''.join(fetch(base + '/b', pool=pool))
+    '/b 0\n/b 1\n/b 2\n'
+    >>> pool.opened
+    1
+
+:func:`~calabash.common.curl` splits the body into lines, and
+:func:`~calabash.common.curl_many` fetches URLs from stdin concurrently::
+
+    >>> from calabash.common import curl, curl_many
+    >>> list(curl(base + '/c', pool=pool))
+    ['/c 0\n', '/c 1\n', '/c 2\n']
+    >>> urls = [base + '/' + name for name in 'xyz']
+    >>> [body.split()[0] for url, body in urls | curl_many(pool=pool)]
+    ['/x', '/y', '/z']
+
+A username and password in the URL are sent with HTTP basic
+authentication::
+
+    >>> ''.join(fetch(base.replace('//', '//ann:s%40cret@') + '/whoami',
+    ...               pool=pool))
+    'Basic YW5uOnNAY3JldA=='
+
+    >>> server.shutdown()
+    >>> pool.close()
+"""
+
+import base64
+import httplib
+import socket
+import threading
+import urllib
+import urllib2
+import urlparse
+import zlib
+
+
+class ConnectionPool(object):
+
+    """
+    Keep up to `max_idle` idle connections open to each host.
+
+    The pool is safe to share between threads. :attr:`opened` counts the
+    connections it has created, which is handy for checking that they're
+    being reused.
+    """
+
+    def __init__(self, max_idle=8, timeout=None):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.opened = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, scheme, netloc):
+        """Return ``(connection, reused)`` for a host."""
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+            self.opened += 1
+        if scheme == 'https':
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+        if self.timeout is None:
+            return connection_class(netloc), False
+        return connection_class(netloc, timeout=self.timeout), False
+
+    def release(self, scheme, netloc, connection):
+        """Return a connection with no outstanding response to the pool."""
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """Close every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.itervalues():
+            for connection in connections:
+                connection.close()
+
+
+#: The pool used when none is given explicitly.
+default_pool = ConnectionPool()
+
+_REDIRECTS = (301, 302, 303, 307, 308)
+
+
+def fetch(url, pool=None, chunk_size=65536, headers=None, max_redirects=5):
+    """
+    Fetch an HTTP(S) URL, yielding its decoded body in chunks.
+
+    Redirects are followed, and error responses raise
+    :exc:`urllib2.HTTPError`, just as they would with :func:`urllib2.urlopen`.
+    A ``user:password@`` in the URL is sent as basic authentication.
+    Proxies aren't supported; :func:`~calabash.common.curl` uses
+    :func:`urllib2.urlopen` instead when one is configured.
+    """
+    if pool is None:
+        pool = default_pool
+    request_headers = {'Accept-Encoding': 'gzip, deflate'}
+    request_headers.update(headers or {})
+
+    for _ in xrange(max_redirects + 1):
+        parts = urlparse.urlsplit(url)
+        credentials, _, netloc = parts.netloc.rpartition('@')
+        host = (parts.scheme, netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        url_headers = request_headers
+        if credentials:
+            url_headers = dict(request_headers, Authorization='Basic ' +
+                               base64.b64encode(urllib.unquote(credentials)))
+        connection, response = _request(pool, host, path, url_headers)
+
+        if response.status in _REDIRECTS and response.getheader('location'):
+            _finish(pool, host, connection, response)
+            url = urlparse.urljoin(url, response.getheader('location'))
+            continue
+        if response.status >= 400:
+            _finish(pool, host, connection, response)
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                                    response.msg, None)
+        break
+    else:
+        raise urllib2.URLError('too many redirects fetching %s' % (url,))
+
+    return _read_body(pool, host, connection, response, chunk_size)
+
+
+def _request(pool, host, path, headers):
+    """Send a GET, retrying once if a reused connection has gone stale."""
+    while True:
+        connection, reused = pool.acquire(*host)
+        try:
+            connection.request('GET', path, headers=headers)
+            return connection, connection.getresponse()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            if not reused:
+                raise
+
+
+def _finish(pool, host, connection, response):
+    """Discard the rest of a response and return its connection to the pool."""
+    response.read()
+    if response.will_close:
+        connection.close()
+    else:
+        pool.release(host[0], host[1], connection)
+
+
+def _read_body(pool, host, connection, response, chunk_size):
+    encoding = (response.getheader('content-encoding') or '').lower()
+    if encoding in ('gzip', 'x-gzip'):
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        decoder = zlib.decompressobj()
+    else:
+        decoder = None
+
+    complete = False
+    try:
+        for chunk in iter(lambda: response.read(chunk_size), ''):
+            if decoder is not None:
+                chunk = decoder.decompress(chunk)
+            if chunk:
+                yield chunk
+        if decoder is not None:
+            tail = decoder.flush()
+            if tail:
+                yield tail
+        complete = True
+    finally:
+        if complete and not response.will_close:
+            pool.release(host[0], host[1], connection)
+        else:
+            connection.close()
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+
+"""
+Fuse runs of simple, item-wise pipeline stages into a single iterator chain.
+
+Every ``|`` in a pipeline costs a Python generator frame, and every item pays
+for one generator resumption per stage. Stages which only ever map or filter
+items one-by-one (such as :func:`~calabash.common.map`,
+:func:`~calabash.common.filter`, :func:`~calabash.common.grep` and
+:func:`~calabash.common.sed`) can instead be expressed as a chain of
+:func:`itertools.imap` and :func:`itertools.ifilter` calls, which run entirely
+in C. When a pipeline is iterated, adjacent fusable stages are collapsed into
+one such chain; the output is identical.
+
+Stages can also be *spliceable*, meaning a run of adjacent stages of the same
+kind can be replaced by a single node which does the work of all of them. This
+is how consecutive :func:`~calabash.common.sh` stages get their processes
+connected directly to one another.
+"""
+
+from functools import partial
+import itertools
+import operator
+import sys
+
+from calabash.spool import Replay
+
+
+#: Returned by a ``'mapfilter'`` step to drop the current item.
+SKIP = object()
+
+_steps = {}
+_splicers = {}
+
+_BASE_RECURSION_LIMIT = sys.getrecursionlimit()
+_FRAMES_PER_STAGE = 2
+# Chains up to this deep run within the default limit, so it's left alone.
+_SHALLOW_DEPTH = 400
+# Much beyond this and CPython overflows the C stack (8MB by default on
+# Linux) and crashes, rather than raising RuntimeError.
+_MAX_RECURSION_LIMIT = 20000
+
+
+def fusable(steps):
+    """
+    Register a pipeline generator as fusable.
+
+    `steps` is called with the same arguments as the stage (minus `stdin`),
+    and should return a list of ``(kind, function)`` steps equivalent to the
+    generator, where `kind` is one of:
+
+    ``'map'``
+        Replace each item with ``function(item)``.
+    ``'filter'``
+        Only pass through items for which ``function(item)`` is truthy.
+    ``'filterfalse'``
+        Only pass through items for which ``function(item)`` is falsy.
+    ``'mapfilter'``
+        Replace each item with ``function(item)``, dropping any for which the
+        result is :data:`SKIP`.
+
+    If a particular combination of arguments can't be fused, `steps` may
+    return ``None``, and the stage will run as a normal generator.
+
+        >>> from calabash.pipeline import pipe
+        >>> @pipe
+        ... @fusable(lambda amount: [('map', lambda x: x + amount)])
+        ... def adder(stdin, amount):
+        ...     for item in stdin:
+        ...         yield item + amount
+        >>> pl = [1, 2, 3] | adder(1) | adder(10)
+        >>> explain(pl)
+        '[1, 2, 3] | {adder | adder}'
+        >>> list(pl)
+        [12, 13, 14]
+    """
+    def decorator(func):
+        _steps[func] = steps
+        return func
+    return decorator
+
+
+def steps_for(node):
+    """Return the fused steps for a pipeline stage, or ``None``."""
+    if node.kind != 'stage' or node.func not in _steps:
+        return None
+    return _steps[node.func](*node.args, **node.kwargs)
+
+
+def spliceable(join):
+    """
+    Register a pipeline generator whose adjacent stages can be spliced.
+
+    When two or more stages of the same spliceable generator sit next to each
+    other in a chain, ``join(nodes, head)`` is called with the list of stage
+    nodes, and should return a single node which does the work of all of
+    them (for example, by connecting subprocesses directly to one another).
+    `head` is true if the first node is the source of the chain, and so will
+    be called without any input.
+
+        >>> from calabash.pipeline import pipe
+        >>> from calabash.graph import Stage
+        >>> def join(nodes, head):
+        ...     total = sum(node.args[0] for node in nodes)
+        ...     return Stage(nodes[0].func, (total,))
+        >>> @pipe
+        ... @spliceable(join)
+        ... def adder(stdin, amount):
+        ...     for item in stdin:
+        ...         yield item + amount
+        >>> pl = [1, 2, 3] | adder(1) | adder(10)
+        >>> explain(pl)
+        '[1, 2, 3] | {adder | adder}'
+        >>> list(pl)
+        [12, 13, 14]
+    """
+    def decorator(func):
+        _splicers[func] = join
+        return func
+    return decorator
+
+
+def split_chain(node):
+    """Split a ``|`` chain into its source and a list of stages."""
+    if node.kind != 'pipe':
+        return node, []
+    return node.stages[0], list(node.stages[1:])
+
+
+def plan(node, fed=False):
+    """
+    Work out how to run a ``|`` chain, as a list of ``(nodes, runner, steps)``.
+
+    Each group covers one or more of the chain's original `nodes`, which are
+    run together by calling `runner` (with the previous group's output, or
+    with no input for the first group). `steps` holds the fused steps for
+    groups made only of fusable stages, and is ``None`` otherwise. If `fed`
+    is true, the chain's first node will be given input too.
+    """
+    source, stages = split_chain(node)
+    nodes = [source] + stages
+    if fed:
+        return _fuse(_splice(nodes, None))
+    groups = _splice(nodes, source)
+    return groups[:1] + _fuse(groups[1:])
+
+
+def _splice_key(node):
+    if node.kind == 'stage' and node.func in _splicers:
+        return node.func
+    return None
+
+
+def _splice(nodes, head):
+    groups = []
+    for key, span in itertools.groupby(nodes, _splice_key):
+        span = list(span)
+        if key is None or len(span) == 1:
+            groups.extend(([node], node, None) for node in span)
+        else:
+            runner = _splicers[key](span, span[0] is head)
+            groups.append((span, runner, None))
+    return groups
+
+
+def _fuse(groups):
+    fused = []
+    run, run_steps = [], []
+    for group in groups:
+        nodes = group[0]
+        steps = steps_for(nodes[0]) if len(nodes) == 1 else None
+        if steps is not None:
+            run.append(nodes[0])
+            run_steps.extend(steps)
+            continue
+        if run:
+            fused.append(_close_run(run, run_steps))
+            run, run_steps = [], []
+        fused.append(group)
+    if run:
+        fused.append(_close_run(run, run_steps))
+    return fused
+
+
+def _close_run(run, steps):
+    if len(run) == 1:
+        # A lone fusable stage gains nothing from fusion; leave it alone.
+        return (run, run[0], steps)
+    return (run, partial(_fused, steps), steps)
+
+
+def _fused(steps, stdin):
+    return apply_steps(steps, iter(stdin))
+
+
+def apply_steps(steps, iterator):
+    """Chain the iterators for a list of fused steps onto `iterator`."""
+    for kind, func in steps:
+        if kind == 'map':
+            iterator = itertools.imap(func, iterator)
+        elif kind == 'filter':
+            iterator = itertools.ifilter(func, iterator)
+        elif kind == 'filterfalse':
+            iterator = itertools.ifilterfalse(func, iterator)
+        elif kind == 'mapfilter':
+            iterator = itertools.ifilter(partial(operator.is_not, SKIP),
+                                         itertools.imap(func, iterator))
+        else:
+            raise ValueError("unknown step kind: %r" % (kind,))
+    return iterator
+
+
+def run(node, stdin=None):
+    """
+    Iterate over a ``|`` chain, fusing stages where possible.
+
+    If `stdin` is given, it's fed to the chain's first node.
+
+    This is what :class:`~calabash.pipeline.PipeLine` uses under the hood, so
+    you should never need to call it directly::
+
+        >>> from calabash.common import grep, sed, map, filter
+        >>> pl = (iter(['cat', 'dog', 'cabbage', 'cod']) | grep('^c') |
+        ...       sed('^ca', 'bo', exclusive=True) | map(str.upper) |
+        ...       filter(lambda word: len(word) > 3))
+        >>> list(pl)
+        ['BOBBAGE']
+    """
+    if stdin is None:
+        groups = plan(node)
+        iterator = start(groups)
+        groups = groups[1:]
+    else:
+        groups = plan(node, fed=True)
+        iterator = stdin
+    allow_depth(len(groups))
+    for nodes, runner, steps in groups:
+        iterator = runner(iterator)
+    return iterator
+
+
+def allow_depth(depth):
+    """
+    Make sure the interpreter lets `depth` nested stages pass items along.
+
+    Each generator stage pulls from the one before it, so every item passes
+    through a stack frame per stage, and a chain of a thousand or so stages
+    would hit the default recursion limit. For chains more than a few
+    hundred deep, the interpreter-wide limit is raised as needed (and never
+    lowered), up to a ceiling which still leaves the interpreter able to
+    raise :exc:`RuntimeError` rather than crash; that allows roughly ten
+    thousand stages. Shallower chains leave the limit alone.
+    """
+    if depth <= _SHALLOW_DEPTH:
+        return
+    needed = min(_BASE_RECURSION_LIMIT + _FRAMES_PER_STAGE * depth,
+                 _MAX_RECURSION_LIMIT)
+    if sys.getrecursionlimit() < needed:
+        sys.setrecursionlimit(needed)
+
+
+def start(groups, wrap=None):
+    """
+    Return the input for the second group of a plan, by running the first.
+
+    If the second group would have to buffer its input, and the source can
+    be read again from the start, a :class:`~calabash.spool.Replay` is
+    returned instead of an iterator (a stage is only run again if the second
+    group's `replay` is ``'stages'``). `wrap` is applied to every iterator
+    over the source's output.
+    """
+    source = groups[0][1]
+    mode = len(groups) > 1 and getattr(groups[1][1], 'replay', False)
+    if mode:
+        replay = Replay.of(source, stages=mode == 'stages')
+        if replay is not None:
+            if wrap is None:
+                return replay
+            return Replay(lambda: wrap(iter(replay)))
+    iterator = iter(source())
+    if wrap is None:
+        return iterator
+    return wrap(iterator)
+
+
+def explain(pipeline):
+    """
+    Describe a pipeline, with fused or spliced stages grouped in braces.
+
+        >>> from calabash.common import echo, grep, sed, map
+        >>> explain(echo('a') | grep('a') | sed('a', 'b') | map(str.upper))
+        'echo | {grep | sed | map}'
+        >>> explain(echo('a') | grep('a'))
+        'echo | grep'
+    """
+    node = pipeline.node
+    if node.kind != 'pipe':
+        return node.name()
+    parts = []
+    for nodes, runner, steps in plan(node):
+        names = ' | '.join(node.name() for node in nodes)
+        if len(nodes) > 1:
+            names = '{%s}' % names
+        parts.append(names)
+    return ' | '.join(parts)
@@ -0,0 +1,517 @@
+# -*- coding: utf-8 -*-
+
+"""
+The stage graph behind every :class:`~calabash.pipeline.PipeLine`.
+
+A pipeline is a small tree of nodes: :class:`Stage` leaves wrap a function and
+the arguments bound to it, :class:`Source` leaves wrap plain iterables, and
+:class:`Pipe`, :class:`Product` and :class:`Concat` nodes record how they were
+combined with ``|``, ``*`` and ``+``. A :class:`Batched` node switches the
+chain beneath it into batch mode. Every node is callable in the same way
+as a pipeline function: with no arguments to produce output, or with an input
+iterator as its only argument.
+
+    >>> from calabash.common import echo, grep, map
+    >>> pl = echo('abc') | grep('b') | map(len)
+    >>> pl.node
+    <Pipe: echo | grep | map>
+    >>> [node.kind for node in pl.node.walk()]
+    ['pipe', 'stage', 'stage', 'stage']
+    >>> list(pl)
+    [3]
+"""
+
+from calabash import batch, fusion, metrics, spool
+import itertools
+
+
+class Node(object):
+
+    """
+    Base class for nodes in a stage graph.
+
+    Subclasses set :attr:`kind`, list the names of their child attributes in
+    :attr:`fields`, and implement :meth:`__call__`.
+    """
+
+    __slots__ = ()
+    kind = None
+    fields = ()
+
+    @property
+    def children(self):
+        """A tuple of this node's immediate child nodes."""
+        return tuple(getattr(self, field) for field in self.fields)
+
+    def replace(self, *children):
+        """Return a copy of this node with its children swapped out."""
+        return type(self)(*children)
+
+    def walk(self):
+        """
+        Yield this node and all of its descendants, depth-first.
+
+            >>> from calabash.common import echo
+            >>> node = (echo(1) + echo(2)).node
+            >>> list(node.walk())
+            [<Concat: echo + echo>, <Stage: echo>, <Stage: echo>]
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+    def transform(self, func):
+        """
+        Rebuild this graph bottom-up, passing every node through `func`.
+
+        `func` receives each node after its children have been transformed,
+        and returns either the same node or a replacement for it::
+
+            >>> from calabash.common import echo, map
+            >>> def double(node):
+            ...     if node.kind == 'stage' and node.name() == 'echo':
+            ...         return node.bind(node.args[0] * 2)
+            ...     return node
+            >>> node = (echo(3) | map(str)).node.transform(double)
+            >>> list(node())
+            ['6']
+        """
+        children = self.children
+        if children:
+            new_children = tuple(child.transform(func) for child in children)
+            if any(new is not old
+                   for new, old in zip(new_children, children)):
+                return func(self.replace(*new_children))
+        return func(self)
+
+    @property
+    def __name__(self):
+        return self.name()
+
+    def name(self):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return '<%s: %s>' % (type(self).__name__, self.name())
+
+
+class Stage(Node):
+
+    """
+    A single pipeline function, with any extra arguments bound to it.
+
+    When called with an input iterator, it is passed to `func` as the first
+    positional argument, ahead of the bound `args`.
+    """
+
+    __slots__ = ('func', 'args', 'kwargs')
+    kind = 'stage'
+
+    def __init__(self, func, args=(), kwargs=None):
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = kwargs or {}
+
+    def replace(self):
+        return self
+
+    def bind(self, *args, **kwargs):
+        """Return a copy of this stage with new arguments bound to it."""
+        return Stage(self.func, args, kwargs)
+
+    def name(self):
+        return getattr(self.func, '__name__', repr(self.func))
+
+    def __call__(self, stdin=None):
+        if stdin is None:
+            return self.func(*self.args, **self.kwargs)
+        return self.func(stdin, *self.args, **self.kwargs)
+
+
+class Source(Node):
+
+    """A plain iterable (such as a list or file) at the head of a pipeline."""
+
+    __slots__ = ('iterable',)
+    kind = 'source'
+
+    def __init__(self, iterable):
+        self.iterable = iterable
+
+    def replace(self):
+        return self
+
+    def name(self):
+        return getattr(self.iterable, '__name__', repr(self.iterable))
+
+    def __call__(self, stdin=None):
+        return iter(self.iterable)
+
+
+class Pipe(Node):
+
+    """
+    Feed each node's output into the next (the ``|`` operator).
+
+    The nodes are kept as one flat tuple, :attr:`stages`: any of them which
+    are themselves pipes are spliced in, so ``(a | b) | c`` and ``a | (b | c)``
+    build the same chain, and a chain of any length is only one level deep::
+
+        >>> from calabash.common import echo, grep, map
+        >>> (echo('a') | (grep('a') | map(len))).node.stages
+        (<Stage: echo>, <Stage: grep>, <Stage: map>)
+
+    Combining pipes is constant-time, however ``|`` is associated; the flat
+    tuple is built (in one linear pass) the first time it's needed.
+    """
+
+    __slots__ = ('_parts', '_stages')
+    kind = 'pipe'
+
+    def __init__(self, *nodes):
+        self._parts = nodes
+        self._stages = None
+
+    @property
+    def stages(self):
+        """A tuple of the nodes in this chain, in order."""
+        if self._stages is None:
+            stages = []
+            pending = list(reversed(self._parts))
+            while pending:
+                node = pending.pop()
+                if node.kind != 'pipe':
+                    stages.append(node)
+                elif node._stages is not None:
+                    stages.extend(node._stages)
+                else:
+                    pending.extend(reversed(node._parts))
+            self._stages = tuple(stages)
+            self._parts = None
+        return self._stages
+
+    @property
+    def children(self):
+        return self.stages
+
+    def name(self):
+        return ' | '.join(node.name() for node in self.stages)
+
+    def __call__(self, stdin=None):
+        return fusion.run(self, stdin)
+
+
+class Product(Node):
+
+    """
+    Yield the cross product of two branches (the ``*`` operator).
+
+    Results stream out as soon as both branches have produced an item. Only
+    the right branch's output is kept, in a :class:`~calabash.spool.Spool`
+    which spills to disk past `spill_threshold` items, and is read again for
+    every item from the left branch; if the right branch is a plain iterable
+    which can be read again from the start, it isn't kept at all.
+
+    With a `block` size, the left branch is read in lists of that many items,
+    and the right branch is read once per list rather than once per item.
+    This is much faster when the right branch has spilled, but the pairs come
+    out in a different order.
+
+    When fed input, both branches read all of it. If the input can be read
+    again from the start (see :meth:`calabash.spool.Replay.of`) and `replay`
+    is true, each branch reads it separately (input from a pipeline stage is
+    only run again if `replay` is ``'stages'``); otherwise the right branch is
+    run to completion first, and the input it read is kept for the left. After
+    each run, :attr:`peak_buffered` and :attr:`spilled` hold the number of
+    items that were kept in memory and on disk respectively.
+    """
+
+    __slots__ = ('left', 'right', 'spill_threshold', 'block', 'replay',
+                 'peak_buffered', 'spilled')
+    kind = 'product'
+    fields = ('left', 'right')
+
+    def __init__(self, left, right, spill_threshold=spool.DEFAULT_THRESHOLD,
+                 block=None, replay=True):
+        self.left = left
+        self.right = right
+        self.spill_threshold = spill_threshold
+        self.block = block
+        self.replay = replay
+        self.peak_buffered = self.spilled = 0
+
+    def replace(self, left, right):
+        return Product(left, right, self.spill_threshold, self.block,
+                       self.replay)
+
+    def name(self):
+        return '%s * %s' % (self.left.name(), self.right.name())
+
+    def __call__(self, stdin=None):
+        return itertools.chain.from_iterable(self._rows(stdin))
+
+    def _rows(self, stdin):
+        buffers = [spool.Spool(self.spill_threshold)]
+        right = buffers[0]
+        try:
+            if stdin is None:
+                left = self.left()
+                if self.right.kind == 'source':
+                    right = spool.Replay.of(self.right) or right
+                if right is buffers[0]:
+                    right = _FirstPass(self.right(), right)
+            elif isinstance(stdin, spool.Replay):
+                left = self.left(iter(stdin))
+                right = _FirstPass(self.right(iter(stdin)), right)
+            else:
+                stdin = iter(stdin)
+                buffers.append(spool.Spool(self.spill_threshold))
+                for item in self.right(_recording(stdin, buffers[1])):
+                    right.append(item)
+                left = self.left(itertools.chain(buffers[1], stdin))
+
+            izip, repeat = itertools.izip, itertools.repeat
+            if self.block is None:
+                for item in left:
+                    yield izip(repeat(item), right)
+            else:
+                left = iter(left)
+                islice = itertools.islice
+                for block in iter(lambda: list(islice(left, self.block)), []):
+                    yield itertools.chain.from_iterable(
+                        izip(block, repeat(other)) for other in right)
+        finally:
+            self.peak_buffered = sum(buffer.in_memory for buffer in buffers)
+            self.spilled = sum(buffer.spilled for buffer in buffers)
+            for buffer in buffers:
+                buffer.close()
+
+
+class _FirstPass(object):
+
+    """
+    Iterate over `iterator` the first time, keeping its items in `buffer`;
+    iterate over `buffer` every time after that.
+    """
+
+    def __init__(self, iterator, buffer):
+        self.iterator = iterator
+        self.buffer = buffer
+
+    def __iter__(self):
+        if self.iterator is None:
+            return iter(self.buffer)
+        iterator, self.iterator = self.iterator, None
+        return _recording(iterator, self.buffer)
+
+
+class Concat(Node):
+
+    """
+    Chain the output of two branches together (the ``+`` operator).
+
+    When fed input, both branches need to read all of it, one after the
+    other. If the input can be read again from the start (see
+    :meth:`calabash.spool.Replay.of`) and `replay` is true, each branch reads
+    it separately (input from a pipeline stage is only run again if `replay`
+    is ``'stages'``); otherwise whatever the left branch reads is kept in a
+    :class:`~calabash.spool.Spool` for the right branch, spilling to disk past
+    `spill_threshold` items. After each run, :attr:`peak_buffered` and
+    :attr:`spilled` hold the number of items that were kept in memory and on
+    disk respectively.
+    """
+
+    __slots__ = ('left', 'right', 'spill_threshold', 'replay',
+                 'peak_buffered', 'spilled')
+    kind = 'concat'
+    fields = ('left', 'right')
+
+    def __init__(self, left, right, spill_threshold=spool.DEFAULT_THRESHOLD,
+                 replay=True):
+        self.left = left
+        self.right = right
+        self.spill_threshold = spill_threshold
+        self.replay = replay
+        self.peak_buffered = self.spilled = 0
+
+    def replace(self, left, right):
+        return Concat(left, right, self.spill_threshold, self.replay)
+
+    def name(self):
+        return '%s + %s' % (self.left.name(), self.right.name())
+
+    def __call__(self, stdin=None):
+        if stdin is None:
+            return itertools.chain.from_iterable(
+                _deferred((self.left, None), (self.right, None)))
+        if isinstance(stdin, spool.Replay):
+            self.peak_buffered = self.spilled = 0
+            return itertools.chain.from_iterable(
+                node(iter(stdin)) for node in (self.left, self.right))
+        return itertools.chain.from_iterable(self._buffered(iter(stdin)))
+
+    def _buffered(self, stdin):
+        buffer = spool.Spool(self.spill_threshold)
+        try:
+            yield self.left(_recording(stdin, buffer))
+            self.peak_buffered, self.spilled = buffer.in_memory, buffer.spilled
+            yield self.right(itertools.chain(buffer, stdin))
+        finally:
+            buffer.close()
+
+
+class Batched(Node):
+
+    """
+    Run a ``|`` chain in batch mode (see :mod:`calabash.batch`).
+
+    `size` is the number of items per chunk, or ``'auto'`` to tune it while
+    the pipeline runs.
+    """
+
+    __slots__ = ('child', 'size')
+    kind = 'batched'
+    fields = ('child',)
+
+    def __init__(self, child, size=batch.DEFAULT_SIZE):
+        self.child = child
+        self.size = size
+
+    def replace(self, child):
+        return Batched(child, self.size)
+
+    def name(self):
+        return self.child.name()
+
+    def __call__(self, stdin=None):
+        return batch.run(self.child, self.size, stdin)
+
+
+class Forked(Node):
+
+    """
+    Run each group of stages in a ``|`` chain in its own process, connected
+    by bounded queues (see :func:`calabash.parallel.run_stages`).
+    """
+
+    __slots__ = ('child', 'chunksize', 'maxsize')
+    kind = 'forked'
+    fields = ('child',)
+
+    def __init__(self, child, chunksize=256, maxsize=16):
+        self.child = child
+        self.chunksize = chunksize
+        self.maxsize = maxsize
+
+    def replace(self, child):
+        return Forked(child, self.chunksize, self.maxsize)
+
+    def name(self):
+        return self.child.name()
+
+    def __call__(self, stdin=None):
+        from calabash import parallel
+        return parallel.run_stages(self.child, self.chunksize, self.maxsize,
+                                   stdin)
+
+
+class Sharded(Node):
+
+    """
+    Run copies of a pipeline on hash partitions of its input, each in its
+    own process (see :func:`calabash.parallel.run_shards`).
+    """
+
+    __slots__ = ('child', 'key', 'shards', 'ordered', 'chunksize', 'maxsize')
+    kind = 'sharded'
+    fields = ('child',)
+
+    def __init__(self, child, key, shards=None, ordered=False, chunksize=256,
+                 maxsize=16):
+        self.child = child
+        self.key = key
+        self.shards = shards
+        self.ordered = ordered
+        self.chunksize = chunksize
+        self.maxsize = maxsize
+
+    def replace(self, child):
+        return Sharded(child, self.key, self.shards, self.ordered,
+                       self.chunksize, self.maxsize)
+
+    def name(self):
+        return self.child.name()
+
+    def __call__(self, stdin=None):
+        from calabash import parallel
+        return parallel.run_shards(self.child, self.key, self.shards,
+                                   self.ordered, self.chunksize, self.maxsize,
+                                   stdin)
+
+
+class Metered(Node):
+
+    """
+    Record per-stage metrics while running a ``|`` chain (see
+    :mod:`calabash.metrics`).
+
+    The gauges for the latest run are kept in :attr:`gauges`, and `callback`,
+    if given, is called with the final report when a run finishes.
+    """
+
+    __slots__ = ('child', 'callback', 'gauges')
+    kind = 'metered'
+    fields = ('child',)
+
+    def __init__(self, child, callback=None):
+        self.child = child
+        self.callback = callback
+        self.gauges = []
+
+    def replace(self, child):
+        return Metered(child, self.callback)
+
+    def name(self):
+        return self.child.name()
+
+    def stats(self):
+        """Return the report for the latest (or current) run."""
+        return metrics.report(self.gauges)
+
+    def __call__(self, stdin=None):
+        return metrics.run(self, stdin)
+
+
+def _recording(iterator, buffer):
+    """Pass items through, appending each one to `buffer` on the way."""
+    append = buffer.append
+    for item in iterator:
+        append(item)
+        yield item
+
+
+def _deferred(*calls):
+    """Call each node with its input only once the previous one is used up."""
+    for node, stdin in calls:
+        yield node(stdin)
+
+
+def node_for(obj):
+    """
+    Return the graph node for a pipeline, function or plain iterable.
+
+        >>> node_for([1, 2])
+        <Source: [1, 2]>
+        >>> node_for(len)
+        <Stage: len>
+    """
+    if isinstance(obj, Node):
+        return obj
+    node = getattr(obj, 'node', None)
+    if isinstance(node, Node):
+        return node
+    if callable(obj) and not hasattr(obj, '__iter__'):
+        return Stage(obj)
+    return Source(obj)
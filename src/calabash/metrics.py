@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+"""
+Opt-in, per-stage runtime metrics.
+
+Call :meth:`~calabash.pipeline.PipeLine.instrumented` on a pipeline to get a
+copy which records, for each group of stages that runs together (see
+:func:`~calabash.fusion.explain`), how many items went in and out, how long
+was spent inside it, and its throughput. Time spent waiting on upstream
+stages isn't counted. Uninstrumented pipelines run exactly as before, so
+there's no overhead unless you ask for it.
+
+    >>> from calabash.common import grep, map
+    >>> from calabash.pipeline import pipe
+    >>> @pipe
+    ... def words():
+    ...     return iter(['apple', 'banana', 'avocado', 'cherry'])
+    >>> pl = (words() | grep('^a') | map(len)).instrumented()
+    >>> list(pl)
+    [5, 7]
+    >>> [(s['stage'], s['items_in'], s['items_out']) for s in pl.stats()]
+    [('words', None, 4), ('grep | map', 4, 2)]
+
+Each entry in the report is a dictionary with these keys:
+
+``stage``
+    The names of the stages in the group.
+``items_in``, ``items_out``
+    The number of items read and yielded. ``items_in`` is ``None`` for the
+    head of the pipeline.
+``seconds``
+    The time spent inside the group, excluding upstream stages.
+``items_per_second``
+    ``items_out`` divided by ``seconds``, or ``None`` if no time was
+    measured.
+
+Groups containing a ``+`` or ``*`` combinator also have ``buffered`` and
+``spilled`` keys, giving the number of items it kept in memory and on disk
+(see :mod:`calabash.spool`). If such a group reads a list or file from the
+start again for each branch, rather than keeping its items, the items are
+only counted once::
+
+    >>> pl = ([1, 2, 3] | (map(str) + map(repr))).instrumented()
+    >>> len(list(pl)), [s['items_out'] for s in pl.stats()]
+    (6, [3, 6])
+
+The report can be read while the pipeline is still running; to export it
+when a run finishes, pass a `callback`, which is called with the final
+report::
+
+    >>> reports = []
+    >>> pl = (words() | map(len)).instrumented(callback=reports.append)
+    >>> sum(pl)
+    24
+    >>> [s['items_out'] for s in reports[0]]
+    [4, 4]
+"""
+
+import time
+
+from calabash import fusion
+
+
+class Gauge(object):
+
+    """Running totals for one group of stages."""
+
+    __slots__ = ('nodes', 'items', 'seconds')
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.items = 0
+        self.seconds = 0.0
+
+
+class Passes(object):
+
+    """
+    Running totals for the head of a pipeline, which may be read from the
+    start more than once (see :class:`~calabash.spool.Replay`).
+
+    Each pass gets a :class:`Gauge` from :meth:`start`. Items are counted
+    for the longest pass only, but time is counted for all of them.
+    """
+
+    __slots__ = ('nodes', 'passes')
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.passes = []
+
+    def start(self):
+        gauge = Gauge(self.nodes)
+        self.passes.append(gauge)
+        return gauge
+
+    @property
+    def items(self):
+        return max([gauge.items for gauge in self.passes] or [0])
+
+    @property
+    def seconds(self):
+        return sum(gauge.seconds for gauge in self.passes)
+
+
+class Meter(object):
+
+    """
+    Wrap an iterator, adding the items pulled through it and the time spent
+    fetching them to a :class:`Gauge`.
+    """
+
+    __slots__ = ('iterator', 'gauge')
+
+    def __init__(self, iterator, gauge):
+        self.iterator = iterator
+        self.gauge = gauge
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        clock = time.time
+        start = clock()
+        try:
+            item = self.iterator.next()
+        finally:
+            self.gauge.seconds += clock() - start
+        self.gauge.items += 1
+        return item
+
+
+def run(node, stdin=None):
+    """
+    Iterate over a :class:`~calabash.graph.Metered` node's chain, metering
+    every group of stages and recording the gauges on the node.
+    """
+    groups = fusion.plan(node.child, fed=stdin is not None)
+    if stdin is None:
+        head = Passes(groups[0][0])
+        iterator = fusion.start(groups, lambda it: Meter(it, head.start()))
+        groups = groups[1:]
+    else:
+        # Only here to measure the time spent upstream.
+        head = Gauge(None)
+        iterator = Meter(iter(stdin), head)
+    # Every meter adds a stack frame of its own.
+    fusion.allow_depth(2 * len(groups))
+    node.gauges = [head]
+    for nodes, runner, steps in groups:
+        gauge = Gauge(nodes)
+        iterator = Meter(iter(runner(iterator)), gauge)
+        node.gauges.append(gauge)
+    return _reporting(iterator, node)
+
+
+def _reporting(iterator, node):
+    try:
+        for item in iterator:
+            yield item
+    finally:
+        if node.callback is not None:
+            node.callback(report(node.gauges))
+
+
+def report(gauges):
+    """Turn a list of gauges, each fed by the one before, into a report."""
+    stats = []
+    previous = None
+    for gauge in gauges:
+        if gauge.nodes is None:
+            previous = gauge
+            continue
+        seconds = gauge.seconds
+        if previous is not None:
+            seconds = max(0.0, seconds - previous.seconds)
+        entry = {
+            'stage': ' | '.join(n.name() for n in gauge.nodes),
+            'items_in': None if previous is None else previous.items,
+            'items_out': gauge.items,
+            'seconds': seconds,
+            'items_per_second': gauge.items / seconds if seconds else None,
+        }
+        buffers = [n for n in gauge.nodes if hasattr(n, 'peak_buffered')]
+        if buffers:
+            entry['buffered'] = sum(n.peak_buffered for n in buffers)
+            entry['spilled'] = sum(n.spilled for n in buffers)
+        stats.append(entry)
+        previous = gauge
+    return stats
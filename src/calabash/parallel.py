@@ -0,0 +1,688 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pipeline components which spread work across several processes or threads.
+"""
+
+import collections
+import cPickle as pickle
+import itertools
+import traceback
+
+from calabash import graph
+from calabash.pipeline import pipe
+
+
+def _portable(exc):
+    """
+    Attach the current traceback to `exc`, making sure it can be sent to
+    another process.
+
+    Some exceptions pickle but can't be unpickled, such as
+    :exc:`subprocess.CalledProcessError` (or anything else whose
+    ``__init__`` needs more arguments than it passes on to
+    :class:`Exception`), so they're replaced with a :exc:`RuntimeError`
+    holding the traceback.
+    """
+    exc.remote_traceback = traceback.format_exc()
+    try:
+        pickle.loads(pickle.dumps(exc, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        exc = RuntimeError(exc.remote_traceback)
+        exc.remote_traceback = exc.args[0]
+    return exc
+
+
+def _map_chunk(func, chunk):
+    """Run `func` over a chunk, returning ``(ok, results_or_exception)``."""
+    try:
+        return True, [func(item) for item in chunk]
+    except Exception, exc:
+        return False, _portable(exc)
+
+
+def _unwrap(outcome):
+    ok, payload = outcome
+    if not ok:
+        raise payload
+    return payload
+
+
+@pipe
+def pmap(stdin, func, workers=None, chunksize=64, ordered=True, inflight=None):
+    """
+    Map each item on stdin through `func`, using a pool of processes.
+
+        >>> list(xrange(-3, 3) | pmap(abs, workers=2, chunksize=2))
+        [3, 2, 1, 0, 1, 2]
+
+    Items are sent to the `workers` processes (by default, one per CPU) in
+    chunks of `chunksize`. At most `inflight` chunks (by default, twice the
+    number of workers) are out at once, so a fast producer upstream can't
+    flood memory. With ``ordered=False``, results are yielded chunk-by-chunk
+    as soon as they're ready, which keeps every worker busy even when some
+    items take much longer than others::
+
+        >>> sorted(xrange(-3, 3) | pmap(abs, workers=2, ordered=False))
+        [0, 1, 1, 2, 2, 3]
+
+    `func` and the items must be picklable, so `func` should be a built-in or
+    a module-level function. If `func` raises, the pool is shut down and the
+    same exception is raised from the pipeline, with the worker's formatted
+    traceback attached as its `remote_traceback` attribute::
+
+        >>> list(['1', 'x'] | pmap(int, workers=2))
+        Traceback (most recent call last):
+        ...
+        ValueError: invalid literal for int() with base 10: 'x'
+
+    An exception which can't be sent back from the worker intact (because
+    it can't be unpickled) is raised as a :exc:`RuntimeError` instead, whose
+    message is the worker's traceback::
+
+        >>> import subprocess
+        >>> try:
+        ...     list(['false'] | pmap(subprocess.check_call, workers=1))
+        ... except RuntimeError, exc:
+        ...     print exc.remote_traceback.splitlines()[-1]
+        CalledProcessError: Command 'false' returned non-zero exit status 1
+    """
+    import multiprocessing
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if inflight is None:
+        inflight = workers * 2
+
+    stdin = iter(stdin)
+    chunks = iter(lambda: list(itertools.islice(stdin, chunksize)), [])
+    pool = multiprocessing.Pool(workers)
+    try:
+        if ordered:
+            results = _ordered_results(pool, func, chunks, inflight)
+        else:
+            results = _unordered_results(pool, func, chunks, inflight)
+        for chunk in results:
+            for item in chunk:
+                yield item
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+@pipe
+def tmap(stdin, func, workers=8, ordered=True, timeout=None):
+    """
+    Map each item on stdin through `func`, using a pool of threads.
+
+    This is a drop-in replacement for :func:`~calabash.common.map` when
+    `func` spends most of its time blocked on I/O (DNS lookups, file stats,
+    network calls and so on). At most `workers` items are processed at once::
+
+        >>> list(['a', 'b', 'c'] | tmap(str.upper, workers=2))
+        ['A', 'B', 'C']
+
+    With ``ordered=False``, results are yielded as soon as they're ready,
+    rather than in input order. If `timeout` is given, and any item takes
+    longer than that many seconds, :exc:`multiprocessing.TimeoutError` is
+    raised::
+
+        >>> import time
+        >>> list([0, 5] | tmap(time.sleep, timeout=0.1))
+        Traceback (most recent call last):
+        ...
+        TimeoutError
+
+    Threads can't be interrupted, so a timed-out call will carry on in the
+    background until it finishes; its result is discarded. Exceptions raised
+    by `func` propagate just as they do for :func:`pmap`.
+    """
+    from multiprocessing.pool import ThreadPool
+
+    chunks = ([item] for item in stdin)
+    pool = ThreadPool(workers)
+    try:
+        if ordered:
+            results = _ordered_results(pool, func, chunks, workers, timeout)
+        else:
+            results = _unordered_results(pool, func, chunks, workers, timeout)
+        for chunk in results:
+            yield chunk[0]
+    finally:
+        # Don't join: a timed-out thread may still be running.
+        pool.terminate()
+
+
+@pipe
+def buffer(stdin, size=1024, max_bytes=None, stop_timeout=0.1):
+    """
+    Read ahead from upstream in a background thread.
+
+    Up to `size` items are read before they're needed, so slow I/O upstream
+    (:func:`~calabash.common.cat`, :func:`~calabash.common.curl`,
+    :func:`~calabash.common.sh` and so on) overlaps with slow work
+    downstream, instead of each waiting on the other::
+
+        >>> list(xrange(5) | buffer(2))
+        [0, 1, 2, 3, 4]
+
+    With `max_bytes`, the items (which must then have a length, like strings)
+    are also limited to that many bytes in total, though a single item larger
+    than that is still let through.
+
+    Exceptions from upstream are raised once the items read before them have
+    been yielded. If the consumer stops early, the background thread stops
+    reading and closes the upstream iterator, so generators upstream get to
+    run their ``finally`` blocks::
+
+        >>> @pipe
+        ... def numbers():
+        ...     try:
+        ...         for number in itertools.count():
+        ...             yield number
+        ...     finally:
+        ...         print 'closed'
+        >>> output = iter(numbers() | buffer(4))
+        >>> output.next(), output.next()
+        (0, 1)
+        >>> output.close()
+        closed
+
+    Closing the output only waits a moment (`stop_timeout` seconds) for
+    that. If upstream is blocked waiting for input (say, a ``tail -f``
+    through :func:`~calabash.common.sh`, or a socket), the background thread
+    closes it once its next item turns up, or never, if none does.
+    """
+    import threading
+
+    reader = _ReadAhead(size, max_bytes)
+    thread = threading.Thread(target=reader.fill, args=(stdin,))
+    thread.daemon = True
+    thread.start()
+    try:
+        for item in reader.drain():
+            yield item
+    finally:
+        reader.stop()
+        thread.join(stop_timeout)
+
+
+class _ReadAhead(object):
+
+    """
+    A bounded buffer between a reader thread and a consumer.
+
+    Appending to and popping from a deque are atomic, so the two threads
+    only take the lock to go to sleep, or to wake the other one up. Before
+    each look at the buffer that might send it to sleep, a thread sets its
+    `waiting` flag (which waking it clears), so a wake-up can't be missed.
+    """
+
+    def __init__(self, size, max_bytes):
+        import threading
+
+        self.size = size
+        self.max_bytes = max_bytes
+        self.items = collections.deque()
+        # Each counter is only ever written by one thread.
+        self.bytes_in = self.bytes_out = 0
+        self.finished = self.stopped = False
+        self.filler_waiting = self.drainer_waiting = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def _full(self):
+        return (len(self.items) >= self.size or
+                (self.max_bytes is not None and
+                 self.bytes_in - self.bytes_out >= self.max_bytes))
+
+    def _low(self):
+        """True once the buffer has drained enough to wake the filler."""
+        return (len(self.items) <= self.size // 2 and
+                (self.max_bytes is None or
+                 self.bytes_in - self.bytes_out <= self.max_bytes // 2))
+
+    def fill(self, stdin):
+        import sys
+
+        items = self.items
+        iterator = iter(stdin)
+        try:
+            for item in iterator:
+                items.append(item)
+                if self.max_bytes is not None:
+                    self.bytes_in += len(item)
+                if self.drainer_waiting:
+                    self._wake('drainer_waiting')
+                if self._full() and not self._wait_for_room():
+                    break
+                if self.stopped:
+                    break
+        except Exception:
+            self.error = sys.exc_info()
+        finally:
+            if self.stopped and hasattr(iterator, 'close'):
+                iterator.close()
+            with self.condition:
+                self.finished = True
+                self.condition.notify()
+
+    def _wait_for_room(self):
+        with self.condition:
+            while True:
+                self.filler_waiting = True
+                if not self._full() or self.stopped:
+                    break
+                self.condition.wait()
+            self.filler_waiting = False
+            return not self.stopped
+
+    def _wake(self, flag):
+        with self.condition:
+            if getattr(self, flag):
+                setattr(self, flag, False)
+                self.condition.notify()
+
+    def drain(self):
+        popleft = self.items.popleft
+        while True:
+            try:
+                item = popleft()
+            except IndexError:
+                if self._wait_for_items():
+                    continue
+                break
+            if self.max_bytes is not None:
+                self.bytes_out += len(item)
+            if self.filler_waiting and self._low():
+                self._wake('filler_waiting')
+            yield item
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def _wait_for_items(self):
+        """Sleep until there are items; False if there will be no more."""
+        with self.condition:
+            while True:
+                self.drainer_waiting = True
+                if self.items or self.finished:
+                    break
+                self.condition.wait()
+            self.drainer_waiting = False
+            return bool(self.items)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.items.clear()
+            self.condition.notify()
+
+
+def _ordered_results(pool, func, chunks, inflight, timeout=None):
+    import time
+
+    pending = collections.deque()
+
+    def next_result():
+        deadline, result = pending.popleft()
+        if deadline is None:
+            return _unwrap(result.get())
+        return _unwrap(result.get(max(0, deadline - time.time())))
+
+    for chunk in chunks:
+        deadline = None if timeout is None else time.time() + timeout
+        pending.append((deadline, pool.apply_async(_map_chunk, (func, chunk))))
+        if len(pending) >= inflight:
+            yield next_result()
+    while pending:
+        yield next_result()
+
+
+def _unordered_results(pool, func, chunks, inflight, timeout=None):
+    import multiprocessing
+    import Queue
+    import time
+
+    done = Queue.Queue()
+    deadlines = {}
+
+    def next_result():
+        if timeout is None:
+            index, outcome = done.get()
+        else:
+            try:
+                index, outcome = done.get(
+                    True, max(0, min(deadlines.itervalues()) - time.time()))
+            except Queue.Empty:
+                raise multiprocessing.TimeoutError
+        del deadlines[index]
+        return _unwrap(outcome)
+
+    for index, chunk in enumerate(chunks):
+        deadlines[index] = None if timeout is None else time.time() + timeout
+        pool.apply_async(_map_chunk, (func, chunk),
+                         callback=lambda outcome, index=index:
+                                  done.put((index, outcome)))
+        if len(deadlines) >= inflight:
+            yield next_result()
+    while deadlines:
+        yield next_result()
+
+
+def run_stages(node, chunksize=256, maxsize=16, stdin=None):
+    r"""
+    Run each group of stages in a ``|`` chain in its own process.
+
+    The groups are the ones :func:`~calabash.fusion.plan` would run, so fused
+    stages share a process. Like a shell pipeline, all of them run at once,
+    connected by queues holding at most `maxsize` chunks of `chunksize`
+    items, so throughput is limited by the slowest group rather than by the
+    sum of all of them::
+
+        >>> from calabash.common import map, sh
+        >>> pl = xrange(5) | map(lambda n: '%d\n' % n) | sh('sort -r') | map(int)
+        >>> list(run_stages(pl.node, chunksize=2))
+        [4, 3, 2, 1, 0]
+
+    Use :meth:`~calabash.pipeline.PipeLine.forked` rather than calling this
+    directly. The processes are forked, so stages needn't be picklable, but
+    every item passed between them must be; an item which can't be pickled
+    raises an error, just like an exception in any stage does. Exceptions
+    are raised from the pipeline, with a `remote_traceback` attribute as for
+    :func:`pmap`::
+
+        >>> import threading
+        >>> list(run_stages(([1] | map(lambda n: threading.Lock())).node))
+        Traceback (most recent call last):
+        ...
+        TypeError: can't pickle thread.lock objects
+    """
+    import multiprocessing
+
+    from calabash import fusion
+
+    groups = fusion.plan(node, fed=stdin is not None)
+    inbox = feed = None
+    if stdin is not None:
+        inbox = feed = multiprocessing.Queue(maxsize)
+    processes = []
+    for nodes, runner, steps in groups:
+        outbox = multiprocessing.Queue(maxsize)
+        processes.append(multiprocessing.Process(
+            target=_stage_worker, args=(runner, inbox, outbox, chunksize),
+            name=' | '.join(n.name() for n in nodes)))
+        inbox = outbox
+    return _collect(processes, inbox, feed, stdin, chunksize)
+
+
+def _stage_worker(runner, inbox, outbox, chunksize):
+    try:
+        if inbox is None:
+            iterator = iter(runner())
+        else:
+            iterator = iter(runner(_received(inbox)))
+        islice = itertools.islice
+        for chunk in iter(lambda: list(islice(iterator, chunksize)), []):
+            outbox.put(('items', _pack(chunk)))
+        outbox.put(('done', None))
+    except _UpstreamError, exc:
+        outbox.put(('error', exc.args[0]))
+    except Exception, exc:
+        outbox.put(('error', _portable(exc)))
+
+
+def _pack(chunk):
+    """
+    Pickle a chunk of items to send to another process.
+
+    A :class:`multiprocessing.Queue` pickles in a background thread, which
+    just prints (and drops the chunk) if it fails; pickling first means the
+    sender finds out, and can send an error instead.
+    """
+    return pickle.dumps(chunk, pickle.HIGHEST_PROTOCOL)
+
+
+class _UpstreamError(Exception):
+    """Raised in a stage process when an earlier stage has failed."""
+
+
+def _received(inbox):
+    while True:
+        kind, payload = inbox.get()
+        if kind == 'items':
+            for item in pickle.loads(payload):
+                yield item
+        elif kind == 'done':
+            return
+        else:
+            raise _UpstreamError(payload)
+
+
+def _collect(processes, outbox, feed, stdin, chunksize):
+    feeder = args = None
+    if feed is not None:
+        feeder, args = _feed_chunks, (stdin, feed, chunksize)
+    messages = _supervise(processes, outbox, feeder, args)
+    try:
+        for kind, payload in messages:
+            if kind == 'items':
+                for item in pickle.loads(payload):
+                    yield item
+            elif kind == 'done':
+                return
+            else:
+                raise payload
+    finally:
+        messages.close()
+
+
+def _supervise(processes, outbox, feeder=None, args=()):
+    """
+    Start `processes` (and a thread calling ``feeder(*args + (stop,))``, if
+    given), then yield the messages put on `outbox` until closed, raising if
+    any of the processes dies.
+    """
+    import Queue
+    import threading
+
+    stop = threading.Event()
+    for process in processes:
+        process.daemon = True
+        process.start()
+    if feeder is not None:
+        thread = threading.Thread(target=feeder, args=args + (stop,))
+        thread.daemon = True
+        thread.start()
+    try:
+        while True:
+            try:
+                message = outbox.get(True, 0.1)
+            except Queue.Empty:
+                for process in processes:
+                    if process.exitcode:
+                        raise RuntimeError(
+                            "stage process %r died with exit code %d" %
+                            (process.name, process.exitcode))
+                continue
+            yield message
+    finally:
+        stop.set()
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+
+def _put(queue, message, stop):
+    """Put `message` on `queue`, giving up (and returning False) on `stop`."""
+    import Queue
+
+    while not stop.is_set():
+        try:
+            queue.put(message, True, 0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+def _feed_chunks(stdin, feed, chunksize, stop):
+    try:
+        stdin = iter(stdin)
+        islice = itertools.islice
+        for chunk in iter(lambda: list(islice(stdin, chunksize)), []):
+            if not _put(feed, ('items', _pack(chunk)), stop):
+                return
+        message = ('done', None)
+    except Exception, exc:
+        message = ('error', _portable(exc))
+    _put(feed, message, stop)
+
+
+def run_shards(node, key, shards=None, ordered=False, chunksize=256,
+               maxsize=16, stdin=None):
+    """
+    Run copies of a pipeline on hash partitions of its input, in parallel.
+
+    Each input item is sent to shard number ``hash(key(item)) % shards``, so
+    items with equal keys always go through the same copy of `node`. Every
+    shard runs in its own process (by default, one per CPU), and is sent
+    its items in lists of `chunksize`, through a queue holding at most
+    `maxsize` of them; their output comes back the same way.
+
+    By default, output is yielded as it arrives from the shards, so items
+    from different shards are interleaved unpredictably. With `ordered`, all
+    of the first shard's output is yielded, then all of the second's, and so
+    on, with output from later shards kept in a
+    :class:`~calabash.spool.Spool` until its turn comes::
+
+        >>> from calabash.common import map
+        >>> pl = xrange(8) | map(lambda n: n * 10)
+        >>> list(run_shards(pl.node, lambda n: n % 2, shards=2, ordered=True))
+        [0, 20, 40, 60, 10, 30, 50, 70]
+
+    Use :meth:`~calabash.pipeline.PipeLine.sharded` rather than calling this
+    directly. If there's no `stdin`, the first stage of `node` is run in this
+    process to produce the items to partition. As with :func:`run_stages`,
+    the processes are forked, items must be picklable, and exceptions are
+    raised from the pipeline with a `remote_traceback` attribute.
+    """
+    import multiprocessing
+
+    from calabash import fusion
+
+    if shards is None:
+        shards = multiprocessing.cpu_count()
+    if stdin is None:
+        source, stages = fusion.split_chain(node)
+        if not stages:
+            raise ValueError("a sharded pipeline needs a stage to run on "
+                             "each shard")
+        stdin = source()
+        node = stages[0] if len(stages) == 1 else graph.Pipe(*stages)
+    outbox = multiprocessing.Queue(maxsize)
+    feeds, processes = [], []
+    for shard in xrange(shards):
+        feed = multiprocessing.Queue(maxsize)
+        processes.append(multiprocessing.Process(
+            target=_stage_worker,
+            args=(node, feed, _Tagged(outbox, shard), chunksize),
+            name='%s [shard %d]' % (node.name(), shard)))
+        feeds.append(feed)
+    messages = _supervise(processes, outbox, _feed_shards,
+                          (stdin, key, feeds, chunksize))
+    if ordered:
+        return _in_shard_order(messages, shards)
+    return _in_arrival_order(messages, shards)
+
+
+class _Tagged(object):
+
+    """Tag each message put on a shared queue with the shard it came from."""
+
+    def __init__(self, queue, shard):
+        self.queue = queue
+        self.shard = shard
+
+    def put(self, message):
+        self.queue.put((self.shard, message))
+
+
+def _feed_shards(stdin, key, feeds, chunksize, stop):
+    shards = len(feeds)
+    chunks = [[] for feed in feeds]
+    try:
+        for item in stdin:
+            shard = hash(key(item)) % shards
+            chunk = chunks[shard]
+            chunk.append(item)
+            if len(chunk) >= chunksize:
+                if not _put(feeds[shard], ('items', _pack(chunk)), stop):
+                    return
+                chunks[shard] = []
+        for feed, chunk in zip(feeds, chunks):
+            if chunk and not _put(feed, ('items', _pack(chunk)), stop):
+                return
+        message = ('done', None)
+    except Exception, exc:
+        message = ('error', _portable(exc))
+    for feed in feeds:
+        _put(feed, message, stop)
+
+
+def _in_arrival_order(messages, shards):
+    running = shards
+    try:
+        for shard, (kind, payload) in messages:
+            if kind == 'items':
+                for item in pickle.loads(payload):
+                    yield item
+            elif kind == 'done':
+                running -= 1
+                if not running:
+                    return
+            else:
+                raise payload
+    finally:
+        messages.close()
+
+
+def _in_shard_order(messages, shards):
+    from calabash.spool import Spool
+
+    current, finished, spools = 0, set(), {}
+    try:
+        for shard, (kind, payload) in messages:
+            if kind == 'error':
+                raise payload
+            if shard != current:
+                if kind == 'done':
+                    finished.add(shard)
+                    continue
+                if shard not in spools:
+                    spools[shard] = Spool()
+                append = spools[shard].append
+                for item in pickle.loads(payload):
+                    append(item)
+                continue
+            if kind == 'items':
+                for item in pickle.loads(payload):
+                    yield item
+                continue
+            # Catch up on the shards after this one.
+            current += 1
+            while current < shards:
+                if current in spools:
+                    for item in spools[current]:
+                        yield item
+                    spools.pop(current).close()
+                if current not in finished:
+                    break
+                current += 1
+            if current == shards:
+                return
+    finally:
+        for spool in spools.itervalues():
+            spool.close()
+        messages.close()
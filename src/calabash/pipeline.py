@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 
 from functools import wraps
-import itertools
+
+from calabash import batch, graph, prepared, spool
 
 
 class PipeLine(object):
@@ -114,19 +115,151 @@ class PipeLine(object):
         13
         14
         15
+
+    Every stage adds to the stack, so running a chain of more than a few
+    hundred stages raises the interpreter's recursion limit (see
+    :func:`sys.setrecursionlimit`) enough to run it, for the rest of the
+    process; it's never lowered again. Shorter chains leave it alone.
     """
 
-    __slots__ = ('coro_func',)
+    __slots__ = ('node',)
 
     def __init__(self, coro_func):
-        self.coro_func = coro_func
+        self.node = graph.node_for(coro_func)
+
+    @property
+    def coro_func(self):
+        """The callable which produces this pipeline's output."""
+        return self.node
 
     @property
     def __name__(self):
-        return self.coro_func.__name__
+        return self.node.name()
 
     def __repr__(self):
-        return '<PipeLine: %s>' % getattr(self.coro_func, '__name__', repr(self.coro_func))
+        return '<PipeLine: %s>' % self.node.name()
+
+    def transform(self, func):
+        """
+        Return a new pipeline with its stage graph rewritten by `func`.
+
+        See :meth:`calabash.graph.Node.transform` for details::
+
+            >>> @pipe
+            ... def count(stop):
+            ...     return iter(xrange(stop))
+            >>> def shorter(node):
+            ...     if node.kind == 'stage':
+            ...         return node.bind(2)
+            ...     return node
+            >>> list(count(5).transform(shorter))
+            [0, 1]
+        """
+        return PipeLine(self.node.transform(func))
+
+    def batched(self, size=batch.DEFAULT_SIZE):
+        """
+        Return a copy of this pipeline which runs in batch mode.
+
+        Items are passed between stages in lists of `size` items; pass
+        ``size='auto'`` to have the chunk size tuned as the pipeline runs.
+        See :mod:`calabash.batch` for details::
+
+            >>> from calabash.common import grep, map
+            >>> pl = ['a1', 'b2', 'a3'] | grep('^a') | map(str.upper)
+            >>> list(pl.batched(2))
+            ['A1', 'A3']
+            >>> list(pl.batched('auto'))
+            ['A1', 'A3']
+        """
+        return PipeLine(graph.Batched(self.node, size))
+
+    def forked(self, chunksize=256, maxsize=16):
+        """
+        Return a copy of this pipeline which runs each stage in a process.
+
+        Like a shell pipeline, every stage (or group of fused stages) runs at
+        once in its own process, and items are passed between them through
+        queues in lists of `chunksize`, with at most `maxsize` lists waiting
+        between any two stages. Items must be picklable. See
+        :func:`calabash.parallel.run_stages` for details::
+
+            >>> from calabash.common import map
+            >>> list((xrange(4) | map(str)).forked(chunksize=3))
+            ['0', '1', '2', '3']
+        """
+        return PipeLine(graph.Forked(self.node, chunksize, maxsize))
+
+    def sharded(self, key, shards=None, ordered=False, chunksize=256,
+                maxsize=16):
+        """
+        Return a copy of this pipeline which runs as `shards` processes.
+
+        Its input is split by ``hash(key(item))``, so that items with equal
+        keys all go to the same process, and every process runs its own
+        copy of this pipeline. `shards` defaults to the number of CPUs.
+        Output is yielded as it arrives, or, with `ordered`, one shard's
+        output after another. See :func:`calabash.parallel.run_shards` for
+        details::
+
+            >>> @pipe
+            ... def count(stdin):
+            ...     counts = {}
+            ...     for word in stdin:
+            ...         counts[word] = counts.get(word, 0) + 1
+            ...     return iter(sorted(counts.items()))
+            >>> words = 'a b a c b a'.split()
+            >>> sorted(words | count().sharded(key=str, shards=2))
+            [('a', 3), ('b', 2), ('c', 1)]
+        """
+        return PipeLine(graph.Sharded(self.node, key, shards, ordered,
+                                      chunksize, maxsize))
+
+    def prepare(self):
+        """
+        Plan this pipeline once, for running on many different inputs.
+
+        Returns a :class:`~calabash.prepared.Prepared` pipeline, which is
+        called with an iterable to feed to the first stage::
+
+            >>> from calabash.common import map
+            >>> doubled = map(lambda x: x * 2).prepare()
+            >>> list(doubled([1, 2])), list(doubled(xrange(3)))
+            ([2, 4], [0, 2, 4])
+        """
+        return prepared.Prepared(self.node)
+
+    def instrumented(self, callback=None):
+        """
+        Return a copy of this pipeline which records per-stage metrics.
+
+        Read them with :meth:`stats`, or pass a `callback` to be called with
+        the report when each run finishes. See :mod:`calabash.metrics` for
+        details::
+
+            >>> from calabash.common import map
+            >>> pl = ([1, 2, 3] | map(str)).instrumented()
+            >>> list(pl)
+            ['1', '2', '3']
+            >>> [(s['stage'], s['items_out']) for s in pl.stats()]
+            [('[1, 2, 3]', 3), ('map', 3)]
+        """
+        return PipeLine(graph.Metered(self.node, callback))
+
+    def stats(self):
+        """
+        Return the metrics report for an instrumented pipeline's latest run.
+
+            >>> from calabash.common import echo
+            >>> echo('a').stats()
+            Traceback (most recent call last):
+            ...
+            ValueError: pipeline isn't instrumented; call instrumented() first
+        """
+        if self.node.kind != 'metered':
+            raise ValueError("pipeline isn't instrumented; "
+                             "call instrumented() first")
+        return self.node.stats()
 
     def __or__(self, target):
         return target.__ror__(self)
@@ -145,12 +278,7 @@ class PipeLine(object):
             >>> list(p)
             [4, 5, 6, 7]
         """
-        def pipe():
-            return self.coro_func(iter(source))
-        pipe.__name__ = '%s | %s' % (
-                getattr(source, '__name__', repr(source)),
-                getattr(self.coro_func, '__name__', repr(self.coro_func)))
-        return PipeLine(pipe)
+        return PipeLine(graph.Pipe(graph.node_for(source), self.node))
 
     def __mul__(self, other):
         """
@@ -165,15 +293,49 @@ class PipeLine(object):
             >>> list(echo([0, 1]) * echo([9, 10]))
             [(0, 9), (0, 10), (1, 9), (1, 10)]
         """
-        def product(stdin=None):
-            if stdin is None:
-                return itertools.product(self, other)
-            stdin1, stdin2 = itertools.tee(stdin, 2)
-            return itertools.product((stdin1 | self), (stdin2 | other))
-        product.__name__ = '%s * %s' % (
-            getattr(self.coro_func, '__name__', repr(self.coro_func)),
-            getattr(other, '__name__', repr(other)))
-        return pipe(product)()
+        return PipeLine(graph.Product(self.node, graph.node_for(other)))
+
+    def product(self, other, spill_threshold=spool.DEFAULT_THRESHOLD,
+                block=None, replay=True):
+        """
+        Like ``self * other``, but with control over how the right side is kept.
+
+        Pairs are yielded as soon as they're ready. The output of `other` is
+        kept so it can be read again for every item from this pipeline; past
+        `spill_threshold` items, the rest is pickled to a temporary file::
+
+            >>> @pipe
+            ... def echo(values):
+            ...     for x in values:
+            ...         yield x
+            >>> @pipe
+            ... def relay(stdin):
+            ...     for x in stdin:
+            ...         yield x
+            >>> pl = echo([0, 1]).product(echo('abc'), spill_threshold=2)
+            >>> list(pl)
+            [(0, 'a'), (0, 'b'), (0, 'c'), (1, 'a'), (1, 'b'), (1, 'c')]
+            >>> pl.node.peak_buffered, pl.node.spilled
+            (2, 1)
+
+        With a `block` size, this pipeline's output is read in lists of that
+        many items, and `other` is read once per list, which saves a lot of
+        disk reads for large products. Within each block, the pairs come out
+        grouped by their right-hand item instead::
+
+            >>> list(echo([0, 1, 2]).product(echo('ab'), block=2))
+            [(0, 'a'), (1, 'a'), (0, 'b'), (1, 'b'), (2, 'a'), (2, 'b')]
+
+        `replay` works as for :meth:`concat`, so a stage which feeds both
+        sides is only run once, unless you pass ``replay='stages'``::
+
+            >>> numbers = iter([1, 2])
+            >>> pl = PipeLine(lambda: numbers) | relay().product(relay())
+            >>> list(pl)
+            [(1, 1), (1, 2), (2, 1), (2, 2)]
+        """
+        return PipeLine(graph.Product(self.node, graph.node_for(other),
+                                      spill_threshold, block, replay))
 
     def __add__(self, other):
         """
@@ -188,18 +350,54 @@ class PipeLine(object):
             >>> list(echo([1, 2, 3]) + echo([4, 5, 6]))
             [1, 2, 3, 4, 5, 6]
         """
-        def concat(stdin=None):
-            if stdin is None:
-                return itertools.chain(self, other)
-            stdin1, stdin2 = itertools.tee(stdin, 2)
-            return itertools.chain((stdin1 | self), (stdin2 | other))
-        concat.__name__ = '%s + %s' % (
-            getattr(self.coro_func, '__name__', repr(self.coro_func)),
-            getattr(other, '__name__', repr(other)))
-        return pipe(concat)()
+        return PipeLine(graph.Concat(self.node, graph.node_for(other)))
+
+    def concat(self, other, spill_threshold=spool.DEFAULT_THRESHOLD,
+               replay=True):
+        """
+        Like ``self + other``, but with control over how input is buffered.
+
+        Both branches have to read all of the pipeline's input. If it can be
+        read again from the start (a list, or a file on disk) each branch
+        reads it separately, unless `replay` is false. Otherwise, the items
+        read by the first branch are kept for the second, and once there are
+        more than `spill_threshold` of them the rest are pickled to a
+        temporary file. The graph node records how many items it kept in
+        memory and on disk::
+
+            >>> @pipe
+            ... def adder(input, amount):
+            ...     for item in input:
+            ...         yield item + amount
+            >>> @pipe
+            ... def echo(*values):
+            ...     return iter(values)
+            >>> both = adder(0).concat(adder(10), spill_threshold=2)
+            >>> list(iter([1, 2, 3]) | both)
+            [1, 2, 3, 11, 12, 13]
+            >>> both.node.peak_buffered, both.node.spilled
+            (2, 1)
+            >>> list([1, 2, 3] | both)
+            [1, 2, 3, 11, 12, 13]
+            >>> both.node.peak_buffered, both.node.spilled
+            (0, 0)
+
+        Input from another pipeline is kept in the same way, since running it
+        again might give different output, or repeat its side effects. If it
+        gives the same output every time and has no side effects, pass
+        ``replay='stages'`` to have each branch run it separately instead::
+
+            >>> list(echo(1, 2) | both), both.node.peak_buffered
+            ([1, 2, 11, 12], 2)
+            >>> again = adder(0).concat(adder(10), replay='stages')
+            >>> list(echo(1, 2) | again), again.node.peak_buffered
+            ([1, 2, 11, 12], 0)
+        """
+        return PipeLine(graph.Concat(self.node, graph.node_for(other),
+                                     spill_threshold, replay))
 
     def __iter__(self):
-        return self.coro_func()
+        return self.node()
 
 
 def pipe(func):
@@ -230,10 +428,5 @@ def pipe(func):
     """
     @wraps(func)
     def wrapper(*args, **kwargs):
-        @wraps(func)
-        def coro_func(stdin=None):
-            if stdin is None:
-                return func(*args, **kwargs)
-            return func(stdin, *args, **kwargs)
-        return PipeLine(coro_func)
+        return PipeLine(graph.Stage(func, args, kwargs))
     return wrapper
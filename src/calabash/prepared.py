@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pipelines which are planned once, and then run on many inputs.
+
+Every time a pipeline is iterated, its ``|`` chain is unwound, spliced and
+fused (see :mod:`calabash.fusion`), which for stages like
+:func:`~calabash.common.grep` and :func:`~calabash.common.sed` includes
+working out their patterns. When the same shape of pipeline is run over and
+over on fresh input, do that work once, with
+:meth:`~calabash.pipeline.PipeLine.prepare`::
+
+    >>> from calabash.common import grep, map
+    >>> shout = (grep('^a') | map(str.upper)).prepare()
+    >>> list(shout(['apple', 'banana', 'avocado']))
+    ['APPLE', 'AVOCADO']
+    >>> list(shout(iter(['anchovy'])))
+    ['ANCHOVY']
+
+Arguments bound to a stage can be swapped out with :meth:`Prepared.rebind`,
+which only re-plans the part of the chain that stage belongs to::
+
+    >>> list(shout.rebind(0, '^b')(['apple', 'banana']))
+    ['BANANA']
+"""
+
+from calabash import fusion, graph
+from calabash.spool import Replay
+
+
+class Prepared(object):
+
+    """
+    A pipeline planned ahead of time, ready to be called with its input.
+
+    :attr:`stages` lists the pipeline's stage nodes, in order. Calling a
+    :class:`Prepared` with an iterable feeds it to the first stage and returns
+    an iterator over the last stage's output. Instances never change, so one
+    can be shared between threads.
+
+    A pipeline which starts with a plain iterable already has its input, so
+    it can't be prepared::
+
+        >>> from calabash.common import map
+        >>> ([1, 2] | map(str)).prepare()
+        Traceback (most recent call last):
+        ...
+        ValueError: can't prepare a pipeline with its own input ([1, 2])
+    """
+
+    __slots__ = ('stages', '_groups')
+
+    def __init__(self, node, _groups=None):
+        source, stages = fusion.split_chain(node)
+        if source.kind == 'source':
+            # Its output would ignore whatever input it was called with.
+            raise ValueError("can't prepare a pipeline with its own input "
+                             "(%s)" % (source.name(),))
+        self.stages = tuple([source] + stages)
+        if _groups is None:
+            _groups = fusion.plan(node, fed=True)
+        self._groups = tuple(_groups)
+
+    def __repr__(self):
+        return '<Prepared: %s>' % ' | '.join(n.name() for n in self.stages)
+
+    def __call__(self, source):
+        iterator = None
+        if getattr(self._groups[0][1], 'replay', False):
+            iterator = Replay.of(graph.Source(source))
+        if iterator is None:
+            iterator = iter(source)
+        fusion.allow_depth(len(self._groups))
+        for nodes, runner, steps in self._groups:
+            iterator = runner(iterator)
+        return iterator
+
+    def rebind(self, stage, *args, **kwargs):
+        """
+        Return a copy with new arguments bound to one of the stages.
+
+        `stage` is either an index into :attr:`stages`, or the name of a
+        stage's function, if only one stage has that name.
+        """
+        index = self._index(stage)
+        old = self.stages[index]
+        if old.kind != 'stage':
+            raise TypeError("can't rebind arguments of %r" % (old,))
+        new = old.bind(*args, **kwargs)
+
+        groups, offset = [], 0
+        for group in self._groups:
+            nodes = list(group[0])
+            if offset <= index < offset + len(nodes):
+                nodes[index - offset] = new
+                groups.extend(fusion.plan(_chain(nodes), fed=True))
+            else:
+                groups.append(group)
+            offset += len(nodes)
+        stages = list(self.stages)
+        stages[index] = new
+        return Prepared(_chain(stages), groups)
+
+    def _index(self, stage):
+        if not isinstance(stage, basestring):
+            return range(len(self.stages))[stage]
+        matches = [i for i, node in enumerate(self.stages)
+                   if node.kind == 'stage' and node.name() == stage]
+        if len(matches) != 1:
+            raise ValueError("%d stages are named %r" % (len(matches), stage))
+        return matches[0]
+
+
+def _chain(nodes):
+    if len(nodes) == 1:
+        return nodes[0]
+    return graph.Pipe(*nodes)
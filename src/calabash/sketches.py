@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compact, approximate summaries of streams too big to keep in memory.
+
+A sketch answers one kind of question about everything that's been added to
+it, using a fixed amount of memory, at the cost of a small (and
+predictable) error. Every sketch reports the bytes it uses as
+:attr:`nbytes`.
+"""
+
+import itertools
+import math
+
+
+_MASK64 = (1 << 64) - 1
+
+
+def mix(value):
+    """
+    Scramble the bits of an integer (such as a :func:`hash`) into 64 bits.
+
+    Python's own hashes of small integers are the integers themselves, and
+    hashes of similar tuples are similar, so sketches run them through this
+    (the finalizer from SplitMix64) before using them::
+
+        >>> hash(1), mix(1)
+        (1, 6238072747940578789L)
+    """
+    value &= _MASK64
+    value = ((value ^ (value >> 30)) * 0xbf58476d1ce4e5b9) & _MASK64
+    value = ((value ^ (value >> 27)) * 0x94d049bb133111eb) & _MASK64
+    return value ^ (value >> 31)
+
+
+class BloomFilter(object):
+
+    """
+    A set which uses a fixed amount of memory, but may give false positives.
+
+    It's sized to hold `capacity` items with a false-positive rate of
+    `error_rate`; it never gives false negatives::
+
+        >>> seen = BloomFilter(1000, error_rate=0.01)
+        >>> seen.add('apple')
+        True
+        >>> seen.add('apple')
+        False
+        >>> 'apple' in seen, 'banana' in seen
+        (True, False)
+        >>> len(seen), seen.nbytes, seen.hashes
+        (1, 1199, 7)
+
+    :meth:`add` returns whether the item was new, so checking and adding
+    only hashes it once. Adding more than `capacity` items doesn't fail,
+    but false positives become more likely; :meth:`false_positive_rate`
+    estimates the rate at the current size. Items are hashed with
+    :func:`hash` and :func:`mix`, so anything hashable can be added.
+    """
+
+    __slots__ = ('capacity', 'error_rate', 'bits', 'hashes', 'count', '_bits')
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        log2 = math.log(2)
+        self.bits = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / (log2 * log2))))
+        self.hashes = max(1, int(round(self.bits / float(capacity) * log2)))
+        self.count = 0
+        self._bits = bytearray((self.bits + 7) // 8)
+
+    def __repr__(self):
+        return '<BloomFilter: %d of %d items, %d bytes>' % (
+            self.count, self.capacity, self.nbytes)
+
+    def _probe(self, item):
+        """Return the first bit to check for `item`, and the step between."""
+        mixed = mix(hash(item))
+        return mixed % self.bits, (mixed // self.bits) % self.bits or 1
+
+    def add(self, item):
+        """Add `item`, returning False if it (probably) was already here."""
+        array, bits = self._bits, self.bits
+        position, step = self._probe(item)
+        new = False
+        for _ in xrange(self.hashes):
+            mask = 1 << (position & 7)
+            byte = array[position >> 3]
+            if not byte & mask:
+                array[position >> 3] = byte | mask
+                new = True
+            position += step
+            if position >= bits:
+                position -= bits
+        if new:
+            self.count += 1
+        return new
+
+    def __contains__(self, item):
+        array, bits = self._bits, self.bits
+        position, step = self._probe(item)
+        for _ in xrange(self.hashes):
+            if not array[position >> 3] & (1 << (position & 7)):
+                return False
+            position += step
+            if position >= bits:
+                position -= bits
+        return True
+
+    def __len__(self):
+        """The number of distinct items added (as far as the filter knows)."""
+        return self.count
+
+    @property
+    def nbytes(self):
+        return len(self._bits)
+
+    def false_positive_rate(self):
+        """Estimate the chance that an item not yet added looks present."""
+        return (1 - math.exp(-self.hashes * self.count /
+                             float(self.bits))) ** self.hashes
+
+
+class HyperLogLog(object):
+
+    """
+    Count distinct items, approximately, in a fixed amount of memory.
+
+    Uses ``2 ** precision`` one-byte registers, and has a relative standard
+    error of about ``1.04 / sqrt(2 ** precision)`` (0.8% at the default
+    precision of 14, using 16kB)::
+
+        >>> distinct = HyperLogLog()
+        >>> for n in xrange(100000):
+        ...     distinct.add(n % 5000)
+        >>> abs(distinct.count() - 5000) < 5000 * 3 * distinct.error_rate
+        True
+        >>> distinct.nbytes, round(distinct.error_rate, 4)
+        (16384, 0.0081)
+
+    Two counters with the same precision can be combined with :meth:`merge`,
+    as if all the items had been added to one of them.
+    """
+
+    __slots__ = ('precision', '_registers')
+
+    def __init__(self, precision=14):
+        if not 4 <= precision <= 18:
+            raise ValueError("precision must be between 4 and 18")
+        self.precision = precision
+        self._registers = bytearray(1 << precision)
+
+    def __repr__(self):
+        return '<HyperLogLog: ~%d distinct>' % self.count()
+
+    def add(self, item):
+        hashed = mix(hash(item))
+        bits = 64 - self.precision
+        index = hashed >> bits
+        rank = bits - (hashed & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self._registers[index]:
+            self._registers[index] = rank
+
+    def count(self):
+        """Estimate the number of distinct items added."""
+        # Ertl's improved estimator ("New cardinality estimation algorithms
+        # for HyperLogLog sketches", 2017), which needs no bias correction
+        # for small or large counts.
+        size, bits = len(self._registers), 64 - self.precision
+        histogram = [0] * (bits + 2)
+        for rank in self._registers:
+            histogram[rank] += 1
+        z = size * _tau(1 - histogram[bits + 1] / float(size))
+        for rank in xrange(bits, 0, -1):
+            z = 0.5 * (z + histogram[rank])
+        z += size * _sigma(histogram[0] / float(size))
+        return int(round(size * size / (2 * math.log(2) * z)))
+
+    def merge(self, other):
+        """Add everything counted by `other` to this counter."""
+        if other.precision != self.precision:
+            raise ValueError("can't merge counters of different precision")
+        self._registers = bytearray(
+            max(pair) for pair in zip(self._registers, other._registers))
+
+    @property
+    def error_rate(self):
+        return 1.04 / math.sqrt(len(self._registers))
+
+    @property
+    def nbytes(self):
+        return len(self._registers)
+
+
+def _sigma(x):
+    if x == 1:
+        return float('inf')
+    y, z = 1.0, x
+    while True:
+        x *= x
+        previous, z = z, z + x * y
+        y += y
+        if z == previous:
+            return z
+
+
+def _tau(x):
+    if x == 0 or x == 1:
+        return 0.0
+    y, z = 1.0, 1 - x
+    while True:
+        x = math.sqrt(x)
+        y *= 0.5
+        previous, z = z, z - (1 - x) ** 2 * y
+        if z == previous:
+            return z / 3
+
+
+class CountMinSketch(object):
+
+    """
+    Count how often each item occurs, approximately, in a fixed amount of
+    memory.
+
+    Counts are never too low. With probability ``1 - delta``, each is too
+    high by at most `epsilon` times the total of all counts, which
+    :meth:`error_bound` gives::
+
+        >>> counts = CountMinSketch(epsilon=0.001, delta=0.01)
+        >>> for word in 'the cat saw the dog and the bird'.split():
+        ...     counts.add(word)
+        >>> counts['the'], counts['cat'], counts['fish']
+        (3, 1, 0)
+        >>> counts.total, round(counts.error_bound(), 3), counts.nbytes
+        (8, 0.008, 108760)
+
+    Sketches with the same dimensions can be combined with :meth:`merge`.
+    """
+
+    __slots__ = ('width', 'depth', 'total', '_rows')
+
+    def __init__(self, epsilon=0.001, delta=0.01):
+        import array
+
+        self.width = int(math.ceil(math.e / epsilon))
+        self.depth = int(math.ceil(math.log(1 / delta)))
+        self.total = 0
+        self._rows = [array.array('l', [0]) * self.width
+                      for _ in xrange(self.depth)]
+
+    def __repr__(self):
+        return '<CountMinSketch: %d x %d, total %d>' % (
+            self.depth, self.width, self.total)
+
+    def _columns(self, item):
+        hashed = mix(hash(item))
+        first, step, width = hashed & 0xffffffff, hashed >> 32, self.width
+        return [(first + i * step) % width for i in xrange(self.depth)]
+
+    def add(self, item, count=1):
+        for row, column in zip(self._rows, self._columns(item)):
+            row[column] += count
+        self.total += count
+
+    def __getitem__(self, item):
+        """Estimate how many times `item` has been added."""
+        return min(row[column]
+                   for row, column in zip(self._rows, self._columns(item)))
+
+    def merge(self, other):
+        """Add everything counted by `other` to this sketch."""
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError("can't merge sketches of different sizes")
+        for row, other_row in zip(self._rows, other._rows):
+            for column, count in enumerate(other_row):
+                if count:
+                    row[column] += count
+        self.total += other.total
+
+    def error_bound(self):
+        """The most (with high probability) that any count is too high by."""
+        return math.e / self.width * self.total
+
+    @property
+    def nbytes(self):
+        return sum(row.itemsize * len(row) for row in self._rows)
+
+
+class TDigest(object):
+
+    """
+    Estimate quantiles (medians, percentiles and so on) of a stream of
+    numbers, in a small amount of memory.
+
+    Values are summarised as roughly `compression` weighted centroids, which
+    are kept smallest near the extremes, so the tails are estimated most
+    precisely::
+
+        >>> digest = TDigest()
+        >>> for n in xrange(10007):
+        ...     digest.add(n * 7919 % 10007)    # 0 to 10006, shuffled
+        >>> [round(digest.quantile(q)) for q in (0, 0.5, 0.99, 1)]
+        [0.0, 5003.0, 9906.0, 10006.0]
+        >>> len(digest.centroids()), digest.nbytes
+        (113, 1808)
+
+    Digests can be combined with :meth:`merge`.
+    """
+
+    __slots__ = ('compression', 'count', 'min', 'max', '_means', '_weights',
+                 '_buffer')
+
+    def __init__(self, compression=100):
+        import array
+
+        self.compression = compression
+        self.count = 0
+        self.min = self.max = None
+        self._means = array.array('d')
+        self._weights = array.array('d')
+        self._buffer = []
+
+    def __repr__(self):
+        return '<TDigest: %d values, %d centroids>' % (
+            self.count, len(self._means) + len(self._buffer))
+
+    def add(self, value, weight=1):
+        self._buffer.append((value, weight))
+        self.count += weight
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if len(self._buffer) >= 5 * self.compression:
+            self._compress()
+
+    def _compress(self):
+        import array
+
+        if not self._buffer:
+            return
+        merged = sorted(itertools.chain(
+            itertools.izip(self._means, self._weights), self._buffer))
+        self._buffer = []
+        total = float(self.count)
+        means, weights = array.array('d'), array.array('d')
+        mean, weight = merged[0]
+        before = 0.0
+        limit = self._quantile_limit(0.0)
+        for value, value_weight in itertools.islice(merged, 1, None):
+            combined = weight + value_weight
+            if before + combined <= limit * total:
+                mean += (value - mean) * value_weight / combined
+                weight = combined
+                continue
+            means.append(mean)
+            weights.append(weight)
+            before += weight
+            limit = self._quantile_limit(before / total)
+            mean, weight = value, value_weight
+        means.append(mean)
+        weights.append(weight)
+        self._means, self._weights = means, weights
+
+    def _quantile_limit(self, q):
+        """
+        The furthest quantile a centroid starting at `q` may reach.
+
+        This is the arcsine scale function from Dunning's t-digest paper:
+        each centroid covers one unit of ``compression * asin(2q - 1) / pi``,
+        so those in the tails cover the smallest range of quantiles.
+        """
+        angle = math.asin(2 * q - 1) + math.pi / self.compression
+        if angle >= math.pi / 2:
+            return 1.0
+        return (math.sin(angle) + 1) / 2
+
+    def centroids(self):
+        """Return the ``(mean, weight)`` pairs summarising the values."""
+        self._compress()
+        return zip(self._means, self._weights)
+
+    def quantile(self, q):
+        """Estimate the value below which a fraction `q` of values fall."""
+        if not self.count:
+            raise ValueError("can't take quantiles of an empty digest")
+        self._compress()
+        means, weights = self._means, self._weights
+        target = q * self.count
+        # Interpolate between the centres of neighbouring centroids, and
+        # between the outermost centres and the exact minimum and maximum.
+        previous_mean, previous_position = self.min, 0.0
+        position = 0.0
+        for mean, weight in itertools.izip(means, weights):
+            centre = position + weight / 2.0
+            if target < centre:
+                break
+            previous_mean, previous_position = mean, centre
+            position += weight
+        else:
+            mean, centre = self.max, float(self.count)
+        if centre == previous_position:
+            return float(mean)
+        fraction = (target - previous_position) / (centre - previous_position)
+        return previous_mean + fraction * (mean - previous_mean)
+
+    def merge(self, other):
+        """Add all the values summarised by `other` to this digest."""
+        for mean, weight in other.centroids():
+            self._buffer.append((mean, weight))
+        self.count += other.count
+        for bound in (other.min, other.max):
+            if bound is not None:
+                if self.min is None or bound < self.min:
+                    self.min = bound
+                if self.max is None or bound > self.max:
+                    self.max = bound
+        self._compress()
+
+    @property
+    def nbytes(self):
+        return ((len(self._means) + len(self._weights)) * 8 +
+                len(self._buffer) * 16)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+"""
+Buffers which spill to disk, for combinators that need to see input twice.
+
+When a pipeline's input has to be fed through two branches one after the
+other (as with ``+`` and ``*``), everything the first branch reads must be
+kept until the second branch gets to it. A :class:`Spool` keeps the first
+`threshold` items in memory and pickles the rest to a temporary file. Where
+the input can simply be read again (a list, or a file on disk),
+:class:`Replay` lets each branch read it from scratch instead.
+A :class:`Run` writes a whole sequence straight to a compressed file, for
+stages like :func:`~calabash.common.sort` which spill in bulk.
+"""
+
+import cPickle as pickle
+import itertools
+import os
+import struct
+import tempfile
+import zlib
+
+
+#: Number of items a :class:`Spool` keeps in memory before spilling to disk.
+DEFAULT_THRESHOLD = 100000
+
+
+class Spool(object):
+
+    """
+    An append-only list of items which can be iterated over many times.
+
+    Once it holds `threshold` items in memory, further items are pickled to
+    an anonymous temporary file, so they must be picklable::
+
+        >>> spool = Spool(threshold=2)
+        >>> for item in range(5):
+        ...     spool.append(item)
+        >>> list(spool), list(spool)
+        ([0, 1, 2, 3, 4], [0, 1, 2, 3, 4])
+        >>> len(spool), spool.in_memory, spool.spilled
+        (5, 2, 3)
+        >>> spool.close()
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD):
+        self.threshold = threshold
+        self.spilled = 0
+        self._memory = []
+        self._file = None
+
+    @property
+    def in_memory(self):
+        """The number of items held in memory."""
+        return len(self._memory)
+
+    def __len__(self):
+        return len(self._memory) + self.spilled
+
+    def append(self, item):
+        if len(self._memory) < self.threshold:
+            self._memory.append(item)
+            return
+        if self._file is None:
+            self._file = tempfile.NamedTemporaryFile(prefix='calabash-spool-')
+        pickle.dump(item, self._file, pickle.HIGHEST_PROTOCOL)
+        self.spilled += 1
+
+    def __iter__(self):
+        if not self.spilled:
+            return iter(self._memory)
+        return itertools.chain(self._memory, self._unspill())
+
+    def _unspill(self):
+        self._file.flush()
+        count = self.spilled
+        with open(self._file.name, 'rb') as spilled:
+            load = pickle.Unpickler(spilled).load
+            for _ in xrange(count):
+                yield load()
+
+    def close(self):
+        """Throw away the contents, and delete the temporary file."""
+        self._memory = []
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.spilled = 0
+
+
+class Run(object):
+
+    """
+    A sequence of items, written once to a compressed temporary file.
+
+    The items are pickled in lists of `block`, each compressed with zlib at
+    the given `level`, and read back a block at a time, as often as needed::
+
+        >>> run = Run(xrange(5), block=2)
+        >>> list(run), list(run)
+        ([0, 1, 2, 3, 4], [0, 1, 2, 3, 4])
+        >>> len(run), run.blocks
+        (5, 3)
+        >>> run.close()
+
+    :attr:`size` is the number of bytes written to disk.
+    """
+
+    _header = struct.Struct('<I')
+
+    def __init__(self, items, block=1024, level=1):
+        self.count = self.blocks = 0
+        # Only hold a file open while writing or reading, so that a sort
+        # can keep many runs on disk at once.
+        fd, self.path = tempfile.mkstemp(prefix='calabash-run-')
+        try:
+            with os.fdopen(fd, 'wb') as run:
+                write, pack = run.write, self._header.pack
+                items = iter(items)
+                for chunk in iter(lambda: list(itertools.islice(items, block)),
+                                  []):
+                    data = zlib.compress(
+                        pickle.dumps(chunk, pickle.HIGHEST_PROTOCOL), level)
+                    write(pack(len(data)))
+                    write(data)
+                    self.count += len(chunk)
+                    self.blocks += 1
+                self.size = run.tell()
+        except:
+            self.close()
+            raise
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return self._read(self.path, self.blocks)
+
+    def _read(self, path, blocks):
+        unpack, header_size = self._header.unpack, self._header.size
+        with open(path, 'rb') as run:
+            read = run.read
+            for _ in xrange(blocks):
+                size, = unpack(read(header_size))
+                for item in pickle.loads(zlib.decompress(read(size))):
+                    yield item
+
+    def close(self):
+        """Delete the temporary file."""
+        if self.path is not None:
+            os.unlink(self.path)
+            self.path = None
+
+
+class Replay(object):
+
+    """
+    Input which can be read from the start again, each time it's iterated.
+
+    Use :meth:`of` to get one for a graph node, if it can be replayed::
+
+        >>> from calabash.graph import node_for
+        >>> replay = Replay.of(node_for([1, 2, 3]))
+        >>> list(replay), list(replay)
+        ([1, 2, 3], [1, 2, 3])
+        >>> print Replay.of(node_for(iter([1, 2, 3])))
+        None
+
+    A pipeline stage is only replayed (by running it again) if you ask for
+    it with `stages`::
+
+        >>> from calabash.common import echo
+        >>> print Replay.of(echo('a').node)
+        None
+        >>> list(Replay.of(echo('a').node, stages=True))
+        ['a']
+    """
+
+    def __init__(self, start):
+        self.start = start
+
+    def __iter__(self):
+        return iter(self.start())
+
+    @classmethod
+    def of(cls, node, stages=False):
+        """
+        Return a :class:`Replay` for a node's output, or ``None``.
+
+        Plain iterables can be replayed if iterating over them again starts
+        from the beginning (lists, tuples, sets and the like), or if they're
+        files on disk which haven't been read from yet; a file is replayed by
+        opening it again. Any other node (such as a pipeline stage) can only
+        be replayed by running it again, which is only right if it gives the
+        same output every time and has no side effects, so that's only done
+        if `stages` is true.
+        """
+        if node.kind != 'source':
+            if stages:
+                return cls(node)
+            return None
+        iterable = node.iterable
+        if isinstance(iterable, file):
+            name, mode = iterable.name, iterable.mode
+            if ('r' in mode and '+' not in mode and os.path.isfile(name) and
+                    iterable.tell() == 0):
+                return cls(lambda: open(name, mode))
+            return None
+        if iter(iterable) is iterable:
+            return None
+        return cls(lambda: iterable)